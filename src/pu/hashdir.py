@@ -1,10 +1,37 @@
 #
 # Copyright (c) 2011-2012 Joshua Hughes <kivhift@gmail.com>
 #
+import binascii
+import bisect
+import collections
+import contextlib
+import errno
 import hashlib
+import heapq
 import io
+import math
+import mmap
+import multiprocessing
+import multiprocessing.pool
 import os
+import Queue
+import stat
+import string
+import struct
+import subprocess
+import sys
 import tempfile
+import threading
+import time
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from pu.serializer import SelfSerializingDataContainer
+from pu.utils import DataContainer, HashCache, hash_file
 
 def files_differ(A, B):
     '''
@@ -29,15 +56,253 @@ def files_differ(A, B):
 
     return differ_status
 
-def get_dir_name_from_hexdigest(digest):
-    return digest[0:2]
+def get_dir_name_from_hexdigest(digest, depth = 1, width = 2):
+    '''
+    Return the fan-out directory for digest.  It's depth levels deep with
+    each level named by the next width characters of digest.
+    '''
+    return os.path.join('', *[digest[i * width : (i + 1) * width]
+        for i in xrange(depth)])
+
+def get_file_name_from_hexdigest(digest, depth = 1, width = 2):
+    return digest[depth * width:]
+
+def get_path_from_hexdigest(digest, depth = 1, width = 2):
+    return os.path.join(get_dir_name_from_hexdigest(digest, depth, width),
+        get_file_name_from_hexdigest(digest, depth, width))
+
+def _make_dir(path):
+    '''
+    Make the directory path if it isn't already there.  It's not an error for
+    another thread or process to beat us to it.
+    '''
+    try:
+        os.mkdir(path)
+    except OSError, e:
+        if errno.EEXIST != e.errno or not os.path.isdir(path): raise
+
+def _publish(name, targ):
+    '''
+    Give the file name the name targ as well and then drop name unless targ
+    is already there.  Return whether name took targ.  Unlike rename(), this
+    doesn't clobber what another writer might have just put at targ.
+    Platforms and file systems without hard links fall back to rename() if
+    targ isn't there, which leaves a window for a racing writer's object
+    to be replaced, though by the same content barring a collision.
+    '''
+    if hasattr(os, 'link'):
+        try:
+            os.link(name, targ)
+        except OSError, e:
+            if errno.EEXIST == e.errno: return False
+            if e.errno not in (errno.EPERM, errno.EOPNOTSUPP, errno.EXDEV,
+                    errno.EMLINK):
+                raise
+        else:
+            os.unlink(name)
+            return True
+    if os.path.exists(targ): return False
+    os.rename(name, targ)
+    return True
+
+# From linux/fs.h; asks the file system to share the extents of one file
+# with another (copy-on-write) instead of copying any data.
+_FICLONE = 0x40049409
+
+def _reflink(src_fd, dst_fd):
+    '''
+    Try to make dst_fd a copy-on-write clone of src_fd.  Return True if it
+    worked, False if the platform or file system isn't up for it.
+    '''
+    if fcntl is None or not sys.platform.startswith('linux'): return False
+    try:
+        fcntl.ioctl(dst_fd, _FICLONE, src_fd)
+    except (IOError, OSError):
+        return False
+    return True
+
+def _write_all(fd, buf):
+    while len(buf):
+        n = os.write(fd, buf)
+        # buffer() doesn't take a memoryview but slicing one doesn't copy.
+        buf = buf[n:] if isinstance(buf, memoryview) else buffer(buf, n)
+
+def _as_buffer(buf):
+    # Return buf as something that hashes and writes as bytes in place and
+    # whose len() is its size in bytes.  A bytearray is wrapped as is and so
+    # is a memoryview of bytes; only one of wider items is copied out.
+    if isinstance(buf, bytearray): return buffer(buf)
+    if isinstance(buf, memoryview) and (1 != buf.itemsize or 1 != buf.ndim):
+        return buf.tobytes()
+    return buf
+
+def _fsync_path(path):
+    # This works for directories as well as files.
+    fd = os.open(path or '.', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+_codecs = {}
+def register_codec(name, compressor, decompressor):
+    '''
+    Make a compression codec available to hashdirs under name.  compressor
+    and decompressor are called without arguments to get objects that act
+    like those from zlib.compressobj() and zlib.decompressobj(); i.e., they
+    have compress()/decompress() methods that take and return buffers and a
+    flush() method that returns whatever is left.
+    '''
+    _codecs[name] = (compressor, decompressor)
+
+register_codec('zlib', zlib.compressobj, zlib.decompressobj)
+
+# Compressed objects start with their uncompressed size.
+_size_header = struct.Struct('>Q')
+
+class _ObjectWriter(object):
+    '''
+    This writes an object's content to a new temporary file in dirname.  If
+    codec is given, then the content is compressed on the way through.
+    '''
+    def __init__(self, dirname, codec = None):
+        self.fd, self.name = tempfile.mkstemp(dir = dirname)
+        self.size = 0
+        self._compressor = None
+        if codec is not None:
+            self._compressor = _codecs[codec][0]()
+            _write_all(self.fd, _size_header.pack(0))
+
+    def write(self, buf):
+        self.size += len(buf)
+        if self._compressor is not None:
+            # Codecs want a str or a read-only buffer.
+            if isinstance(buf, memoryview): buf = buf.tobytes()
+            buf = self._compressor.compress(buf)
+        if buf: _write_all(self.fd, buf)
+
+    def close(self):
+        '''Finish writing and return the temporary file's name.'''
+        try:
+            if self._compressor is not None:
+                _write_all(self.fd, self._compressor.flush())
+                os.lseek(self.fd, 0, os.SEEK_SET)
+                _write_all(self.fd, _size_header.pack(self.size))
+        finally:
+            os.close(self.fd)
+        return self.name
+
+    def abort(self):
+        os.close(self.fd)
+        os.unlink(self.name)
+
+class _DecodingReader(object):
+    '''
+    This is a read-only file-like object that decompresses the rest of the
+    file-like raw as it's read.  length is the uncompressed length.  Seeking
+    forward decompresses and discards whilst seeking backward starts over.
+    raw is closed along with the reader.
+    '''
+    _chunk = 8 * io.DEFAULT_BUFFER_SIZE
+
+    def __init__(self, raw, decompressor, length):
+        self._raw = raw
+        self._decompressor = decompressor
+        self._start = raw.tell()
+        self.length = length
+        self.name = raw.name
+        self._restart()
+
+    def _restart(self):
+        self._raw.seek(self._start)
+        self._d = self._decompressor()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self):
+        return iter(lambda: self.read(self._chunk), '')
+
+    @property
+    def closed(self):
+        return self._raw.closed
+
+    def close(self):
+        self._raw.close()
+
+    def read(self, n = -1):
+        to_go = self.length - self._pos
+        if n is None or n < 0 or n > to_go: n = to_go
+        parts, have = [self._buf], len(self._buf)
+        while have < n and not self._eof:
+            raw = self._raw.read(self._chunk)
+            if raw:
+                buf = self._d.decompress(raw)
+            else:
+                buf = self._d.flush()
+                self._eof = True
+            parts.append(buf)
+            have += len(buf)
+        buf = ''.join(parts)
+        out, self._buf = buf[:n], buf[n:]
+        self._pos += len(out)
+        return out
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence = os.SEEK_SET):
+        if os.SEEK_CUR == whence:
+            offset += self._pos
+        elif os.SEEK_END == whence:
+            offset += self.length
+        if offset < 0: raise IOError(errno.EINVAL, 'Invalid offset.')
+        if offset < self._pos: self._restart()
+        while self._pos < offset:
+            if not self.read(min(self._chunk, offset - self._pos)): break
+
+class _MultiHash(object):
+    '''
+    This is a hashlib-alike that feeds the same data to each of the hashlib
+    algorithms in algos.  hexdigest() is that of the first algorithm.
+    '''
+    def __init__(self, algos):
+        self.algos = list(algos)
+        self._hashes = [hashlib.new(a) for a in self.algos]
 
-def get_file_name_from_hexdigest(digest):
-    return digest[2:]
+    def update(self, buf):
+        for h in self._hashes: h.update(buf)
 
-def get_path_from_hexdigest(digest):
-    return os.path.join(get_dir_name_from_hexdigest(digest),
-        get_file_name_from_hexdigest(digest))
+    def hexdigest(self):
+        return self._hashes[0].hexdigest()
+
+    def hexdigests(self):
+        return dict(zip(self.algos, [h.hexdigest() for h in self._hashes]))
+
+class _StoreConfig(SelfSerializingDataContainer):
+    '''This is what a hashdir records about itself in .hashdir/config.'''
+    _defaults = dict(codec = '', algo = 'sha1', fanout_depth = 1,
+        fanout_width = 2, prev_fanout_depth = 0, prev_fanout_width = 0)
+
+    def __init__(self, *args, **kwargs):
+        super(_StoreConfig, self).__init__(*args, **kwargs)
+        self.fill_defaults()
+
+    def fill_defaults(self):
+        '''Give values to the settings missing from an older config.'''
+        for k, v in _StoreConfig._defaults.iteritems(): self.setdefault(k, v)
+
+def _check_rootdir(rootdir):
+    if rootdir and not os.path.exists(rootdir):
+        raise ValueError('Directory not there: ' + rootdir)
+    if rootdir and not os.path.isdir(rootdir):
+        raise ValueError('Not directory: ' + rootdir)
 
 def add_file(addee, rootdir = '.', rename = False):
     '''
@@ -46,65 +311,2897 @@ def add_file(addee, rootdir = '.', rename = False):
     object.  If rename_file is True and addee is an already extant file,
     then it is moved to the new location instead of a copy of it.
     '''
-    if rootdir and not os.path.exists(rootdir):
-        raise ValueError('Directory not there: ' + rootdir)
-    if rootdir and not os.path.isdir(rootdir):
-        raise ValueError('Not directory: ' + rootdir)
+    _check_rootdir(rootdir)
+    with HashDir(rootdir, rename) as hd:
+        return hd.addFile(addee)
 
-    fi = fdo = None
-    rename_addee = False
+_job_hashdirs = {}
+def _add_file_job(job):
+    # Run in a pool worker process.  The HashDir is rebuilt from its
+    # constructor arguments once per worker since it doesn't pickle.
+    kwargs, addee = job
+    key = tuple(sorted(kwargs.items()))
+    hd = _job_hashdirs.get(key)
+    if hd is None: hd = _job_hashdirs[key] = HashDir(**kwargs)
+    return hd._add_file_caught(addee)
+
+def _tree_files(path, skip = None):
+    skip = os.path.realpath(skip) if skip is not None else None
+    for dirpath, dirnames, filenames in os.walk(path):
+        if skip is not None and os.path.realpath(dirpath) == skip:
+            del dirnames[:]
+            continue
+        dirnames.sort()
+        for fn in sorted(filenames):
+            yield os.path.join(dirpath, fn)
+
+def _edge_digest(path, size, edge):
+    # Digest the first and last edge bytes of the file path; for a file of
+    # no more than 2 * edge bytes, that's all of it.
+    with open(path, 'rb') as f:
+        head = f.read(edge)
+        if size > 2 * edge: f.seek(-edge, os.SEEK_END)
+        tail = f.read(edge)
+    return hashlib.sha1(head + tail).digest()
+
+def _group_by(paths, key):
+    # Return the groups of more than one of paths that share key(path).
+    # Files that can't be read any more are left out.
+    groups = {}
+    for path in paths:
+        try:
+            k = key(path)
+        except EnvironmentError:
+            continue
+        groups.setdefault(k, []).append(path)
+    return [g for g in groups.itervalues() if len(g) > 1]
+
+def _duplicate_groups(job):
+    # Split files of the same size into groups with the same content.
+    size, paths, edge, cache = job
+    groups = _group_by(paths, lambda p: _edge_digest(p, size, edge))
+    if size > 2 * edge:
+        groups = [g for group in groups for g in _group_by(group,
+            lambda p: hash_file(p, cache = cache))]
+    confirmed = []
+    for group in groups:
+        # Matching digests all but guarantee it; files_differ() makes sure.
+        while len(group) > 1:
+            same, rest = [group[0]], []
+            for path in group[1:]:
+                try:
+                    differ = files_differ(group[0], path)
+                except EnvironmentError:
+                    continue
+                (rest if differ else same).append(path)
+            if len(same) > 1: confirmed.append(sorted(same))
+            group = rest
+    return confirmed
+
+def find_duplicates(paths, workers = None, edge = 4096, min_size = 1,
+        hash_cache = None):
+    '''
+    Generate sorted lists of the files under paths, which can be a path or
+    a list of files and directories, that have the same content.  Files are
+    bucketed by size first.  Those that share a size are told apart by
+    hashing their first and last edge bytes and only the ones that still
+    can't be told apart are hashed whole.  Matches are then compared byte
+    for byte.  The sizes are worked through across a pool of workers and
+    each list is generated as soon as its size is done with.  Files
+    smaller than min_size bytes are ignored.  hash_cache can be a
+    pu.utils.HashCache to skip rehashing files that haven't changed.
+    '''
+    if isinstance(paths, basestring): paths = [paths]
+    if workers is None: workers = multiprocessing.cpu_count()
+
+    by_size = {}
+    for path in paths:
+        for fpath in _tree_files(path) if os.path.isdir(path) else [path]:
+            try:
+                st = os.lstat(fpath)
+            except OSError:
+                continue
+            if stat.S_ISREG(st.st_mode) and st.st_size >= min_size:
+                by_size.setdefault(st.st_size, set()).add(fpath)
+    jobs = [(size, sorted(ps), edge, hash_cache)
+        for size, ps in sorted(by_size.iteritems()) if len(ps) > 1]
+    del by_size
+    if not jobs: return
+
+    pool = multiprocessing.pool.ThreadPool(max(1, min(workers, len(jobs))))
     try:
-        if type(addee) in (str, unicode):
-            fi = open(addee, 'rb')
-            rename_addee = rename
-        else:
-            fi = addee
+        for groups in pool.imap_unordered(_duplicate_groups, jobs):
+            for group in groups: yield group
+        pool.close()
+    finally:
+        # Don't wait for the rest if the caller has stopped listening.
+        pool.terminate()
+        pool.join()
 
-        if not rename_addee:
-            fdo, fdo_name = tempfile.mkstemp(dir = rootdir)
-        else:
-            fdo_name = addee
+class _DigestIndex(object):
+    '''
+    This is an append-only log of "<hexdigest> <size>" lines that mirrors
+    which objects are in a hash directory.  The whole log is kept in memory
+    as a dict so that existence and size queries don't have to go to the
+    file system.  Other writers append to the same log and their records
+    are picked up before each lookup.  A size of "-" marks a removed
+    object.  reset() replaces the log with a new file; appenders hold a
+    shared flock while writing and move over to the new file when they
+    see that the one at path isn't theirs anymore.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.sizes = {}
+        self._pos = 0
+        self._lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0644)
+        self.refresh()
 
-        sz = io.DEFAULT_BUFFER_SIZE
-        fhash = hashlib.sha1()
-        while True:
-            buf = fi.read(sz)
-            if not rename_addee: os.write(fdo, buf)
-            fhash.update(buf)
-            if len(buf) < sz: break
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _replaced(self):
+        try:
+            st = os.stat(self.path)
+        except OSError, e:
+            if errno.ENOENT != e.errno: raise
+            return False
+        fst = os.fstat(self._fd)
+        return (st.st_dev, st.st_ino) != (fst.st_dev, fst.st_ino)
+
+    def _read_from(self, pos):
+        # Read the log from pos on through our own descriptor since the
+        # file at path might not be ours anymore.
+        os.lseek(self._fd, pos, os.SEEK_SET)
+        parts = []
+        for buf in iter(lambda: os.read(self._fd, 1 << 20), ''):
+            parts.append(buf)
+        return ''.join(parts)
+
+    def _refresh(self):
+        # Called with _lock held.
+        if self._replaced():
+            os.close(self._fd)
+            self._fd = os.open(self.path, os.O_RDWR | os.O_APPEND)
+            self.sizes, self._pos = {}, 0
+        if os.fstat(self._fd).st_size == self._pos: return
+        data = self._read_from(self._pos)
+        # A record that's still being written will be picked up later.
+        end = data.rfind('\n') + 1
+        sizes = self.sizes
+        for ln in data[:end].splitlines():
+            digest, size = ln.split()
+            if '-' == size:
+                sizes.pop(digest, None)
+            else:
+                sizes[digest] = int(size)
+        self._pos += end
+
+    def refresh(self):
+        '''Read the records appended since the last refresh.'''
+        with self._lock:
+            self._refresh()
+
+    def get(self, digest):
+        '''Return the size of the object for digest or None if absent.'''
+        # Even a hit is checked against the log since another writer might
+        # have removed the object since.
+        with self._lock:
+            self._refresh()
+            return self.sizes.get(digest)
+
+    def mark(self):
+        '''Return where the log is at for reset().'''
+        with self._lock:
+            self._refresh()
+            fst = os.fstat(self._fd)
+            return fst.st_dev, fst.st_ino, self._pos
+
+    def _append(self, record, size):
+        digest = record.split(None, 1)[0]
+        with self._lock:
+            while True:
+                self._refresh()
+                if fcntl is not None: fcntl.flock(self._fd, fcntl.LOCK_SH)
+                try:
+                    if self._replaced(): continue
+                    # O_APPEND makes a single small write atomic with
+                    # respect to other appenders.
+                    os.write(self._fd, record)
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(self._fd, fcntl.LOCK_UN)
+                break
+            if size is None:
+                self.sizes.pop(digest, None)
+            else:
+                self.sizes[digest] = size
+
+    def add(self, digest, size):
+        self._append('%s %d\n' % (digest, size), size)
+
+    def remove(self, digest):
+        self._append('%s -\n' % digest, None)
+
+    def reset(self, sizes, mark = None):
+        '''
+        Replace the log with one holding just sizes.  If mark is what
+        mark() returned before sizes were gathered, then the records
+        appended since are carried over to the new log.
+        '''
+        with self._lock:
+            self._refresh()
+            if fcntl is not None: fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                tail = ''
+                if mark is not None:
+                    fst = os.fstat(self._fd)
+                    since = mark[2] if mark[:2] == (fst.st_dev, fst.st_ino) \
+                        else 0
+                    tail = self._read_from(since)
+                    tail = tail[:tail.rfind('\n') + 1]
+                fd, name = tempfile.mkstemp(dir = os.path.dirname(self.path))
+                try:
+                    os.write(fd, ''.join(['%s %d\n' % (d, sizes[d])
+                        for d in sorted(sizes)]) + tail)
+                finally:
+                    os.close(fd)
+                os.rename(name, self.path)
+            finally:
+                if fcntl is not None: fcntl.flock(self._fd, fcntl.LOCK_UN)
+            self._refresh()
+
+def _streams_differ(A, B):
+    sz = io.DEFAULT_BUFFER_SIZE
+    while True:
+        A_buf, B_buf = A.read(sz), B.read(sz)
+        if A_buf != B_buf: return True
+        if not A_buf: return False
+
+class _PackSlice(object):
+    '''
+    This is a read-only file-like view of length bytes of the file f
+    starting at offset.  f is closed along with the view.
+    '''
+    def __init__(self, f, offset, length):
+        self._f = f
+        self._offset = offset
+        self._length = length
+        self._pos = 0
+        self.name = f.name
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self):
+        return iter(lambda: self.read(io.DEFAULT_BUFFER_SIZE), '')
+
+    @property
+    def closed(self):
+        return self._f.closed
+
+    def close(self):
+        self._f.close()
+
+    def read(self, n = -1):
+        to_go = self._length - self._pos
+        if n is None or n < 0 or n > to_go: n = to_go
+        if n <= 0: return ''
+        self._f.seek(self._offset + self._pos)
+        buf = self._f.read(n)
+        self._pos += len(buf)
+        return buf
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence = os.SEEK_SET):
+        if os.SEEK_CUR == whence:
+            offset += self._pos
+        elif os.SEEK_END == whence:
+            offset += self._length
+        if offset < 0: raise IOError(errno.EINVAL, 'Invalid offset.')
+        self._pos = offset
+
+class _Pack(object):
+    '''
+    A pack is a .pack file of concatenated objects along with an .idx file
+    that maps each object's digest to its offset and length in the .pack.
+    The .idx starts with a header of _idx_header and is followed by
+    fixed-size records of the binary digest followed by _idx_entry and
+    sorted by digest so that lookups can bisect the mmap'd .idx.
+    '''
+    _idx_magic = 'HDPI'
+    _idx_header = struct.Struct('>4sHI')
+    _idx_entry = struct.Struct('>QQ')
+
+    def __init__(self, idx_path):
+        self.idx_path = idx_path
+        self.pack_path = idx_path[:-len('.idx')] + '.pack'
+        with open(idx_path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        magic, self.digest_len, self.count = _Pack._idx_header.unpack_from(
+            self._mm)
+        if _Pack._idx_magic != magic:
+            raise ValueError('Not a pack index: ' + idx_path)
+        self._rec_len = self.digest_len + _Pack._idx_entry.size
+        self._data = None
+        self._data_lock = threading.Lock()
+
+    def close(self):
+        self._mm.close()
+        # Buffers handed out by HashDir.map() might still be using the
+        # .pack's mapping so it's left to go away with the last of them.
+        self._data = None
+
+    def mapping(self):
+        '''Return a read-only mmap of the .pack.'''
+        with self._data_lock:
+            if self._data is None:
+                with open(self.pack_path, 'rb') as f:
+                    self._data = mmap.mmap(f.fileno(), 0,
+                        access = mmap.ACCESS_READ)
+            return self._data
+
+    @staticmethod
+    def write(idx_path, entries, digest_len):
+        '''Write an .idx given (binary digest, offset, length) entries.'''
+        entries = sorted(entries)
+        fd, name = tempfile.mkstemp(dir = os.path.dirname(idx_path))
+        try:
+            parts = [_Pack._idx_header.pack(
+                _Pack._idx_magic, digest_len, len(entries))]
+            for digest, offset, length in entries:
+                parts.append(digest + _Pack._idx_entry.pack(offset, length))
+            _write_all(fd, ''.join(parts))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.rename(name, idx_path)
+
+    def _digest_at(self, i):
+        start = _Pack._idx_header.size + i * self._rec_len
+        return self._mm[start : start + self.digest_len]
+
+    def entries(self):
+        '''Yield (hex digest, offset, length) for every packed object.'''
+        dl, ie = self.digest_len, _Pack._idx_entry
+        for i in xrange(self.count):
+            start = _Pack._idx_header.size + i * self._rec_len
+            offset, length = ie.unpack_from(self._mm, start + dl)
+            yield (binascii.hexlify(self._mm[start : start + dl]),
+                offset, length)
+
+    def find(self, digest):
+        '''Return (offset, length) for the hex digest or None.'''
+        key = binascii.unhexlify(digest)
+        if len(key) != self.digest_len: return None
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._digest_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self._digest_at(lo) == key:
+            return _Pack._idx_entry.unpack_from(self._mm,
+                _Pack._idx_header.size + lo * self._rec_len
+                    + self.digest_len)
+        return None
+
+    def open(self, offset, length):
+        return _PackSlice(open(self.pack_path, 'rb'), offset, length)
+
+class _PackWriter(object):
+    '''This accumulates objects into a new pack in packs_dir.'''
+    def __init__(self, packs_dir):
+        self.packs_dir = packs_dir
+        self._fd, self._name = tempfile.mkstemp(dir = packs_dir)
+        self.entries = []
+        self.size = 0
+
+    def add(self, digest, buf):
+        _write_all(self._fd, buf)
+        self.entries.append((binascii.unhexlify(digest), self.size, len(buf)))
+        self.size += len(buf)
+
+    def abort(self):
+        if self._fd is None: return
+        os.close(self._fd)
+        self._fd = None
+        os.unlink(self._name)
+
+    def finish(self):
+        '''Make the pack visible to readers and return its .idx path.'''
+        fd, self._fd = self._fd, None
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        if not self.entries:
+            os.unlink(self._name)
+            return None
+        name = os.path.join(self.packs_dir, 'pack-' + hashlib.sha1(''.join(
+            sorted([e[0] for e in self.entries]))).hexdigest())
+        os.rename(self._name, name + '.pack')
+        # Readers only look for packs via their .idx so it goes in last.
+        _Pack.write(name + '.idx', self.entries, len(self.entries[0][0]))
+        return name + '.idx'
+
+# Cut points are looked for at occurrences of the anchor byte, which
+# str.find() finds at C speed, and only kept if the CRC-32 of the window of
+# _cdc_window bytes ending with the anchor is small enough.  Both must never
+# change since chunk boundaries, and hence dedup, depend on them.
+_cdc_anchor = '\x8f'
+_cdc_window = 32
+
+def _content_defined_chunks(f, min_size, avg_size, max_size):
+    '''
+    Yield the content of the file-like f cut into chunks at content-defined
+    boundaries.  Chunks are at least min_size bytes (except for the last
+    one), at most max_size bytes and about avg_size bytes on average for
+    content that looks random.  A boundary only depends on the bytes just
+    before it so an insertion or deletion only moves the boundaries near
+    it.  The scanning is done by str.find() and zlib.crc32() so that this
+    keeps up with hashing the content.  Content without the anchor byte,
+    e.g., ASCII text, is only cut at max_size.
+    '''
+    # One byte in 256 is an anchor and the CRC check keeps enough of them
+    # for an average gap of avg_size - min_size.
+    limit = int((1 << 32) * 256.0 / max(avg_size - min_size, 256))
+    find, crc, W = str.find, zlib.crc32, _cdc_window
+    block = max(max_size, 1 << 20)
+
+    # Chunks are cut at offsets into buf, which is only copied when it's
+    # topped up a block at a time.
+    buf, start, eof = '', 0, False
+    while True:
+        while not eof and len(buf) - start < max_size:
+            data = f.read(block)
+            if data:
+                buf = buf[start:] + data
+                start = 0
+            else:
+                eof = True
+        end = min(len(buf), start + max_size)
+        if start == end: return
+
+        # The window has to be within the chunk and no cut can come before
+        # min_size.
+        cut = end
+        i = find(buf, _cdc_anchor, start + max(min_size, W) - 1, end)
+        while i >= 0:
+            if crc(buffer(buf, i + 1 - W, W)) & 0xffffffff < limit:
+                cut = i + 1
+                break
+            i = find(buf, _cdc_anchor, i + 1, end)
+        yield buf[start : cut]
+        start = cut
+
+class _ChunkedReader(object):
+    '''
+    This is a read-only file-like object that reassembles content from its
+    chunks.  entries is a list of (digest, length) tuples and open_chunk is
+    called with a digest to get a file-like object for that chunk.
+    '''
+    def __init__(self, name, entries, open_chunk):
+        self.name = name
+        self._entries = entries
+        self._open_chunk = open_chunk
+        self._starts = []
+        self.length = 0
+        for digest, length in entries:
+            self._starts.append(self.length)
+            self.length += length
+        self._pos = 0
+        self._cur = self._cur_i = None
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self):
+        return iter(lambda: self.read(io.DEFAULT_BUFFER_SIZE), '')
+
+    def close(self):
+        if self._cur is not None: self._cur.close()
+        self._cur = self._cur_i = None
+        self.closed = True
+
+    def read(self, n = -1):
+        to_go = self.length - self._pos
+        if n is None or n < 0 or n > to_go: n = to_go
+        parts = []
+        while n > 0:
+            i = bisect.bisect_right(self._starts, self._pos) - 1
+            if i != self._cur_i:
+                if self._cur is not None: self._cur.close()
+                self._cur = None
+                self._cur = self._open_chunk(self._entries[i][0])
+                self._cur_i = i
+            start = self._starts[i]
+            self._cur.seek(self._pos - start)
+            buf = self._cur.read(
+                min(n, start + self._entries[i][1] - self._pos))
+            if not buf:
+                raise IOError(errno.EIO, 'Truncated chunk',
+                    self._entries[i][0])
+            parts.append(buf)
+            self._pos += len(buf)
+            n -= len(buf)
+        return ''.join(parts)
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence = os.SEEK_SET):
+        if os.SEEK_CUR == whence:
+            offset += self._pos
+        elif os.SEEK_END == whence:
+            offset += self.length
+        if offset < 0: raise IOError(errno.EINVAL, 'Invalid offset.')
+        self._pos = offset
+
+class _BloomFilter(object):
+    '''
+    This is a Bloom filter of digests kept in a file that's mmap'd shared
+    so that additions go straight to the file and are seen by every other
+    user of it.  The file is _header followed by a bit array of 2**log2_bits
+    bits.  The bits for a digest come from double hashing with two 64-bit
+    integers taken from the digest itself since it's already uniformly
+    distributed.  A rebuild replaces the file, so a filter whose file is
+    no longer the one at path maps the new one before it's used.
+    '''
+    _magic = 'HDBF'
+    _header = struct.Struct('>4sBB')
+    _pair = struct.Struct('>QQ')
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        # Mappings of replaced files are kept open until close() since
+        # another thread might still be reading one.
+        self._old = []
+        self._f = None
+        self._map()
+
+    def _map(self):
+        f = open(self.path, 'r+b')
+        try:
+            mm = mmap.mmap(f.fileno(), 0)
+        except:
+            f.close()
+            raise
+        magic, log2_bits, hashes = _BloomFilter._header.unpack_from(mm)
+        if _BloomFilter._magic != magic:
+            mm.close()
+            f.close()
+            raise ValueError('Not a Bloom filter: ' + self.path)
+        if self._f is not None: self._old.append((self._mm, self._f))
+        self._f, self._mm = f, mm
+        self.log2_bits, self.hashes = log2_bits, hashes
+        self._mask = (1 << log2_bits) - 1
+
+    def _replaced(self):
+        try:
+            st = os.stat(self.path)
+        except OSError, e:
+            if errno.ENOENT != e.errno: raise
+            return False
+        fst = os.fstat(self._f.fileno())
+        return (st.st_dev, st.st_ino) != (fst.st_dev, fst.st_ino)
+
+    def refresh(self):
+        '''Map the file at path if it has replaced ours.'''
+        with self._lock:
+            if self._replaced(): self._map()
+
+    @staticmethod
+    def create(path, log2_bits, hashes):
+        '''Make an empty filter at path.'''
+        with open(path, 'wb') as f:
+            f.write(_BloomFilter._header.pack(
+                _BloomFilter._magic, log2_bits, hashes))
+            f.truncate(_BloomFilter._header.size + (1 << log2_bits) // 8)
+
+    def close(self):
+        for mm, f in self._old + [(self._mm, self._f)]:
+            mm.close()
+            f.close()
+        self._old = []
+
+    def _bits(self, digest):
+        h1, h2 = _BloomFilter._pair.unpack_from(binascii.unhexlify(digest))
+        h2 |= 1
+        start, mask = _BloomFilter._header.size, self._mask
+        for i in xrange(self.hashes):
+            bit = (h1 + i * h2) & mask
+            yield start + (bit >> 3), 1 << (bit & 7)
+
+    def set(self, digest):
+        '''Add digest without any locking.'''
+        mm = self._mm
+        for i, bit in self._bits(digest):
+            mm[i] = chr(ord(mm[i]) | bit)
+
+    def add(self, digest):
+        with self._lock:
+            while True:
+                if self._replaced(): self._map()
+                # Setting a bit is a read-modify-write of its byte so other
+                # processes are locked out for the duration.  A rebuild
+                # holds the lock until its file has replaced ours.
+                f = self._f
+                if fcntl is not None: fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    if self._replaced(): continue
+                    self.set(digest)
+                finally:
+                    if fcntl is not None: fcntl.flock(f, fcntl.LOCK_UN)
+                break
+
+    def might_contain(self, digest):
+        # Take the mapping and its parameters together in case refresh()
+        # swaps them.
+        mm, mask, hashes = self._mm, self._mask, self.hashes
+        h1, h2 = _BloomFilter._pair.unpack_from(binascii.unhexlify(digest))
+        h2 |= 1
+        start = _BloomFilter._header.size
+        for i in xrange(hashes):
+            bit = (h1 + i * h2) & mask
+            if not ord(mm[start + (bit >> 3)]) & 1 << (bit & 7):
+                return False
+        return True
+
+class _StoreStats(object):
+    '''
+    This keeps running totals for a hash directory in a small file: the
+    number of objects, their logical (uncompressed) and physical (on disk)
+    sizes and a histogram of the logical sizes.  Bucket i of the histogram
+    counts the objects whose size needs i bits, i.e., that are at least
+    2**(i - 1) bytes and less than 2**i bytes.  The file is _record followed
+    by the CRC-32 of it so that a torn update is caught.  Updates are read-
+    modify-writes under flock() so that other processes' updates aren't
+    lost.
+    '''
+    _magic = 'HDST'
+    _version = 1
+    _buckets = 65
+    _record = struct.Struct('>4sH2xQQQ%dQ' % _buckets)
+    _crc = struct.Struct('>I')
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR)
+        self._lock = threading.Lock()
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    @staticmethod
+    def _pack(totals):
+        rec = _StoreStats._record.pack(_StoreStats._magic,
+            _StoreStats._version, *totals)
+        return rec + _StoreStats._crc.pack(binascii.crc32(rec) & 0xffffffff)
+
+    @staticmethod
+    def create(path, totals = None):
+        '''Make a stats file at path with the given (or zero) totals.'''
+        if totals is None: totals = [0] * (3 + _StoreStats._buckets)
+        with open(path, 'wb') as f:
+            f.write(_StoreStats._pack(totals))
+
+    @staticmethod
+    def bucket(size):
+        return min(size.bit_length(), _StoreStats._buckets - 1)
+
+    def _read(self):
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        size = _StoreStats._record.size
+        data = os.read(self._fd, size + _StoreStats._crc.size)
+        if (len(data) != size + _StoreStats._crc.size
+                or binascii.crc32(data[:size]) & 0xffffffff
+                    != _StoreStats._crc.unpack_from(data, size)[0]):
+            raise IOError(errno.EIO, 'Corrupt stats; rebuild them', self.path)
+        fields = _StoreStats._record.unpack_from(data)
+        if (_StoreStats._magic, _StoreStats._version) != fields[:2]:
+            raise IOError(errno.EIO, 'Not stats', self.path)
+        return list(fields[2:])
+
+    def read(self):
+        '''Return the totals as a pu.utils.DataContainer.'''
+        with self._lock:
+            totals = self._read()
+        return DataContainer(objects = totals[0], logical_bytes = totals[1],
+            physical_bytes = totals[2], histogram = totals[3:])
+
+    def update(self, sign, logical, physical):
+        '''Count an object in (sign of 1) or out (sign of -1).'''
+        with self._lock:
+            if fcntl is not None: fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                totals = self._read()
+                totals[0] += sign
+                totals[1] += sign * logical
+                totals[2] += sign * physical
+                totals[3 + _StoreStats.bucket(logical)] += sign
+                # Totals can't go below zero even if an object was counted
+                # out twice by racing removers.
+                totals = [max(0, t) for t in totals]
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                _write_all(self._fd, _StoreStats._pack(totals))
+            finally:
+                if fcntl is not None: fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+def _sorted_unique(strings, dirname, run_len):
+    '''
+    Write the distinct ones of strings, which must all be of the same
+    length, one per line and sorted to a new temporary file in dirname and
+    return its path.  At most run_len strings are held in memory at once;
+    longer runs are sorted and spilled to temporary files of their own
+    that are then merged.
+    '''
+    runs = []
+    def spill(run):
+        run.sort()
+        fd, name = tempfile.mkstemp(dir = dirname)
+        runs.append(name)
+        with os.fdopen(fd, 'wb') as f:
+            prev = None
+            for x in run:
+                if x != prev: f.write(x + '\n')
+                prev = x
+
+    try:
+        run = []
+        for x in strings:
+            run.append(x)
+            if len(run) >= run_len:
+                spill(run)
+                run = []
+        if run or not runs: spill(run)
+        del run
+        if 1 == len(runs): return runs.pop()
+
+        files = [open(name, 'rb') for name in runs]
+        try:
+            fd, name = tempfile.mkstemp(dir = dirname)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    prev = None
+                    for ln in heapq.merge(*files):
+                        if ln != prev: f.write(ln)
+                        prev = ln
+            except:
+                os.unlink(name)
+                raise
+        finally:
+            for f in files: f.close()
+        return name
     finally:
-        if fi is not None and id(fi) != id(addee): fi.close()
-        if fdo is not None: os.close(fdo)
+        for name in runs: os.unlink(name)
 
-    digest = fhash.hexdigest()
+class _SortedDigests(object):
+    '''
+    This answers whether a digest is in a file written by _sorted_unique()
+    by bisecting an mmap of it so that the digests needn't fit in memory.
+    '''
+    def __init__(self, path, digest_len):
+        self.digest_len = digest_len
+        self._rec_len = digest_len + 1
+        self._mm = None
+        self.count = os.path.getsize(path) // self._rec_len
+        if self.count:
+            with open(path, 'rb') as f:
+                self._mm = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
 
-    fdir = os.path.join(rootdir, get_dir_name_from_hexdigest(digest))
-    if not os.path.exists(fdir): os.mkdir(fdir)
+    def close(self):
+        if self._mm is not None: self._mm.close()
 
-    targ = os.path.join(rootdir, get_path_from_hexdigest(digest))
-    if os.path.exists(targ):
-        if files_differ(fdo_name, targ):
-            raise RuntimeError('Addee collided with extant file: %s, %s' % (
-                fdo_name, targ))
-        os.unlink(fdo_name)
-    else:
-        os.rename(fdo_name, targ)
+    def _digest_at(self, i):
+        start = i * self._rec_len
+        return self._mm[start : start + self.digest_len]
 
-    return digest
+    def __contains__(self, digest):
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._digest_at(mid) < digest:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo < self.count and self._digest_at(lo) == digest
+
+def _is_hex(s):
+    return bool(s) and all(c in string.hexdigits for c in s)
 
 class HashDir(object):
-    def __init__(self, rootdir = '.', rename = False):
+    _meta_dir_name = '.hashdir'
+
+    _mmap_threshold = 1 << 20
+    _mmap_chunk = 1 << 20
+    _pack_threshold = 4096
+    _pack_max_size = 1 << 30
+    _chunk_min = 16 << 10
+    _chunk_avg = 64 << 10
+    _chunk_max = 256 << 10
+    _stray_age = 3600
+    _gc_grace = 3600
+    _gc_run_len = 1 << 20
+    _handle_cache_size = 64
+    _buckets_ttl = 60
+
+    def __init__(self, rootdir = '.', rename = False, workers = None,
+            processes = False, index = False, link = False, codec = None,
+            hash_cache = None, algo = None, fanout = None, bloom = False,
+            durability = None, lock_inflight = False, stats = False):
+        '''
+        workers is the default pool size used by add_files() and defaults to
+        the number of CPUs.  If processes is True, then the pool is made of
+        processes instead of threads.  hashlib releases the GIL whilst
+        hashing sizable buffers so threads usually suffice.
+
+        If index is True, then a digest index is built if the hashdir
+        doesn't already have one.  An extant index is always used and kept
+        up to date regardless of index.
+
+        Large regular files are hashed through an mmap and only copied if
+        the hashdir doesn't already have them.  The copy is a reflink when
+        the file system supports it.  If link is True, then such files are
+        hard linked into the hashdir when possible instead; the addee must
+        not be modified afterwards since it then shares storage with the
+        hashdir's copy.
+
+        codec names a compression codec (see register_codec()) that the
+        objects of the hashdir are stored with; zlib is built in.  It's
+        recorded in the hashdir's configuration and so can only be chosen
+        for a hashdir that doesn't have any objects yet.  Digests are always
+        of the uncompressed content.
+
+        hash_cache can be a pu.utils.HashCache (or the path of one) that's
+        used to skip reading addees that were hashed before and haven't
+        changed since.  If it's True, then .hashdir/hash-cache is used.
+
+        algo names the hashlib algorithm that digests are made with and
+        defaults to sha1.  Like codec, it's recorded in the hashdir's
+        configuration and can only be chosen for an empty hashdir.
+
+        fanout is a (depth, width) tuple giving how many levels of fan-out
+        directories there are and how many digest characters name each
+        level.  The default of (1, 2) gives 256 directories.  It's also
+        recorded in the configuration; use reshard() to change the fan-out
+        of a hashdir that has objects.
+
+        If bloom is True, then a Bloom filter of the hashdir's digests is
+        built if there isn't one already.  contains_many() uses it to answer
+        for absent digests without going to the file system.  Like the
+        index, an extant filter is always used and kept up to date.
+
+        durability says how adds guard against a crash leaving objects
+        that are empty or missing under the digests they were acknowledged
+        with.  With 'none' (the default), nothing is flushed to disk.  With
+        'object', each new object is flushed before it's moved into place
+        and its directory is flushed after.  With 'group', the objects are
+        flushed the same way but the directories are only flushed once per
+        batch of add_files(), add_tree(), add_buffers() or add_chunked()
+        before they return.  Lone adds are committed as a group of one.
+
+        Any number of HashDirs in any number of processes can add to the
+        same hashdir at once.  Objects are published with link() so that
+        racing writers of the same content don't clobber one another.  If
+        lock_inflight is True, then adds that know the digest before they
+        write, i.e., those of large files and add_bytes(), take a lock on
+        the digest under .hashdir/locks so that identical content being
+        added concurrently is only written once.  The locks are flock()s
+        and so go away with a writer that dies holding one.
+
+        If stats is True, then running totals of the hashdir's objects
+        and their sizes are kept in .hashdir/stats if they aren't already
+        so that stats() can answer without walking the hashdir.  Like the
+        index, extant stats are always kept up to date.
+        '''
         self.rootdir = rootdir
         self.rename = rename
+        self.link = link
+        if durability is None: durability = 'none'
+        if durability not in ('none', 'object', 'group'):
+            raise ValueError('Unknown durability: %r' % (durability,))
+        self.durability = durability
+        self.lock_inflight = lock_inflight and fcntl is not None
+        self._local = threading.local()
+        if hash_cache is True:
+            _make_dir(self._meta_path())
+            hash_cache = self._meta_path('hash-cache')
+        # Only a cache opened here is closed by close().
+        self._owns_hash_cache = isinstance(hash_cache, basestring)
+        if self._owns_hash_cache: hash_cache = HashCache(hash_cache)
+        self.hash_cache = hash_cache
+        self.workers = workers
+        self.processes = processes
+        self._dirs = set()
+        self._index = None
+        self._bloom = None
+        self._stats = None
+        self._meta_lock = threading.Lock()
+        self._packs = {}
+        self._packs_lock = threading.Lock()
+        self._handles = collections.OrderedDict()
+        self._handles_lock = threading.Lock()
+
+        self._config = self._load_config()
+        self._apply_config()
+        changed = dict()
+        if codec is not None and codec != self._config.codec:
+            if codec not in _codecs:
+                raise ValueError('Unknown codec: ' + codec)
+            changed['codec'] = codec
+        if algo is not None and algo != self._config.algo:
+            try:
+                hashlib.new(algo)
+            except ValueError:
+                raise ValueError('Unknown algorithm: ' + algo)
+            changed['algo'] = algo
+        if fanout is not None and tuple(fanout) != (
+                self._config.fanout_depth, self._config.fanout_width):
+            self._check_fanout(fanout, changed.get('algo', self.algo))
+            changed['fanout_depth'], changed['fanout_width'] = fanout
+        if changed:
+            if not self._is_empty():
+                raise ValueError('%s can only be chosen for an empty '
+                    'hashdir: %s' % (' and '.join(sorted(changed)), rootdir))
+            self._config.update(changed)
+            self._save_config()
+        self._apply_config()
+
+        index_path = self._meta_path('index')
+        if os.path.exists(index_path):
+            self._index = _DigestIndex(index_path)
+        elif index:
+            self.rebuild_index()
+
+        bloom_path = self._meta_path('bloom')
+        if os.path.exists(bloom_path):
+            self._bloom = _BloomFilter(bloom_path)
+        elif bloom:
+            self.rebuild_bloom()
+
+        stats_path = self._meta_path('stats')
+        if os.path.exists(stats_path):
+            self._stats = _StoreStats(stats_path)
+        elif stats:
+            self.rebuild_stats()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        '''Release the open files and mappings held by the hashdir.'''
+        if self._index is not None: self._index.close()
+        if self._bloom is not None: self._bloom.close()
+        if self._stats is not None: self._stats.close()
+        if self._owns_hash_cache: self.hash_cache.close()
+        with self._handles_lock:
+            self._handles.clear()
+        with self._packs_lock:
+            for pack in self._packs.itervalues(): pack.close()
+            self._packs = {}
+
+    def _config_stamp(self):
+        try:
+            st = os.stat(self._meta_path('config'))
+        except OSError:
+            return None
+        return st.st_ino, st.st_mtime, st.st_size
+
+    def _load_config(self):
+        config = _StoreConfig()
+        path = self._meta_path('config')
+        self._config_loaded = self._config_stamp()
+        if self._config_loaded is not None:
+            config.load(path)
+            config.fill_defaults()
+        return config
+
+    def _save_config(self):
+        _make_dir(self._meta_path())
+        fd, name = tempfile.mkstemp(dir = self._meta_path())
+        with os.fdopen(fd, 'wb') as f:
+            self._config.dump(f)
+        os.rename(name, self._meta_path('config'))
+        self._config_loaded = self._config_stamp()
+
+    def _apply_config(self):
+        c = self._config
+        self.codec = c.codec or None
+        self.algo = c.algo
+        if self.codec is not None and self.codec not in _codecs:
+            raise ValueError('Unknown codec: ' + self.codec)
+        self._digest_len = 2 * hashlib.new(self.algo).digest_size
+        self.fanout = (c.fanout_depth, c.fanout_width)
+        # Loose objects are looked for in the layout being resharded from
+        # before the one being resharded to so that an object moved in
+        # between the two lookups isn't missed.
+        self._fanouts = [self.fanout]
+        if c.prev_fanout_width:
+            self._fanouts.insert(0, (c.prev_fanout_depth, c.prev_fanout_width))
+
+    def _reload_config(self):
+        # Pick up a configuration changed by another HashDir (e.g., one
+        # that's resharding) and return True if there was one.
+        if self._config_stamp() == self._config_loaded: return False
+        self._config = self._load_config()
+        self._apply_config()
+        return True
+
+    def _check_fanout(self, fanout, algo):
+        depth, width = fanout
+        if depth < 0 or width < 1 or (
+                depth * width >= 2 * hashlib.new(algo).digest_size):
+            raise ValueError('Invalid fan-out: %r' % (fanout,))
+
+    def _is_empty(self):
+        for name, path in self._iter_fanout_dirs():
+            if [n for n in os.listdir(path) if _is_hex(n)]: return False
+        for digest, length in self.iter_packed():
+            return False
+        return True
+
+    def _job_args(self):
+        return dict(rootdir = self.rootdir, rename = self.rename,
+            link = self.link, hash_cache = self.hash_cache.path
+                if self.hash_cache is not None else None,
+            durability = self.durability, lock_inflight = self.lock_inflight)
+
+    def _meta_path(self, *names):
+        return os.path.join(self.rootdir, HashDir._meta_dir_name, *names)
+
+    def _ensure_dir(self, path):
+        if path not in self._dirs:
+            _make_dir(path)
+            self._dirs.add(path)
+
+    def _ensure_fanout_dir(self, digest, fanout):
+        depth, width = fanout
+        for i in xrange(1, depth + 1):
+            self._ensure_dir(os.path.join(self.rootdir,
+                get_dir_name_from_hexdigest(digest, i, width)))
+
+    def _loose_paths(self, digest):
+        return [os.path.join(self.rootdir, get_path_from_hexdigest(digest,
+            *fanout)) for fanout in self._fanouts]
+
+    def _find_loose(self, digest, find):
+        # Return find(path) for the first loose path of digest for which it
+        # doesn't raise ENOENT or None if there's no such path.
+        for retry in (False, True):
+            if retry and not self._reload_config(): break
+            for path in self._loose_paths(digest):
+                try:
+                    return find(path)
+                except EnvironmentError, e:
+                    if errno.ENOENT != e.errno: raise
+        return None
+
+    def _refresh_packs(self):
+        packs_dir = self._meta_path('packs')
+        if not os.path.isdir(packs_dir): return
+        with self._packs_lock:
+            names = sorted(os.listdir(packs_dir))
+            for name in names:
+                if not name.endswith('.idx'): continue
+                path = os.path.join(packs_dir, name)
+                if path not in self._packs:
+                    self._packs[path] = _Pack(path)
+            # Packs rewritten by gc() go away.  Their mappings are left to
+            # be closed once nobody's using them.
+            for path in self._packs.keys():
+                if os.path.basename(path) not in names:
+                    del self._packs[path]
+
+    def _find_packed(self, digest):
+        # Return (pack, offset, length) for digest or None.  The list of
+        # packs is only refreshed on a miss.  A hit in a pack that gc()
+        # has since removed, maybe from another HashDir, doesn't count.
+        for refresh in (False, True):
+            if refresh: self._refresh_packs()
+            for pack in self._packs.values():
+                found = pack.find(digest)
+                if found is not None and os.path.exists(pack.idx_path):
+                    return (pack,) + found
+        return None
+
+    def _has_object(self, digest):
+        if self._index is not None:
+            return self._index.get(digest) is not None
+        return self._on_disk(digest)
+
+    def _on_disk(self, digest):
+        return (self._find_loose(digest, os.stat) is not None
+            or self._find_packed(digest) is not None
+            or os.path.exists(self._manifest_path(digest)))
+
+    def _has_stored(self, digest):
+        # Like _has_object() but an index hit is checked on disk before an
+        # add skips writing the object on the strength of it.
+        if not self._has_object(digest): return False
+        return self._index is None or self._on_disk(digest)
+
+    def _manifest_path(self, digest):
+        return self._meta_path('manifests', get_path_from_hexdigest(digest))
+
+    def _read_manifest(self, digest):
+        # Return the (digest, length) list of the chunks of digest or None
+        # if it wasn't added in chunks.
+        try:
+            with open(self._manifest_path(digest), 'rb') as f:
+                data = f.read()
+        except IOError, e:
+            if errno.ENOENT != e.errno: raise
+            return None
+        entries = []
+        for ln in data.splitlines():
+            d, length = ln.split()
+            entries.append((d, int(length)))
+        return entries
+
+    def _write_manifest(self, digest, entries):
+        path = self._manifest_path(digest)
+        dname = os.path.dirname(path)
+        _make_dir(self._meta_path())
+        _make_dir(os.path.dirname(dname))
+        self._ensure_dir(dname)
+        fd, name = tempfile.mkstemp(dir = dname)
+        try:
+            _write_all(fd, ''.join(['%s %d\n' % e for e in entries]))
+            if 'none' != self.durability: os.fsync(fd)
+        finally:
+            os.close(fd)
+        # Return whether this writer's manifest is the one in place.
+        if _publish(name, path): return True
+        os.unlink(name)
+        return False
+
+    def _decoded(self, raw):
+        # Wrap the raw content of an object so that it reads uncompressed.
+        if self.codec is None: return raw
+        length = self._logical_size(raw)
+        return _DecodingReader(raw, _codecs[self.codec][1], length)
+
+    def _logical_size(self, raw):
+        # Return the uncompressed size of the object raw is positioned at
+        # the start of.
+        header = raw.read(_size_header.size)
+        if len(header) != _size_header.size:
+            raise IOError(errno.EIO, 'Truncated object', raw.name)
+        return _size_header.unpack(header)[0]
+
+    def _check_collision(self, path, digest, size, encoded = False):
+        # path holds the content of an addee and is compressed if encoded.
+        # Another writer can beat us to digest before it's indexed it.
+        if size != self._size_on_disk(digest):
+            differ = True
+        else:
+            A = open(path, 'rb')
+            if encoded: A = self._decoded(A)
+            try:
+                with self.openFileFromHexDigest(digest) as B:
+                    differ = _streams_differ(A, B)
+            finally:
+                A.close()
+        if differ:
+            raise RuntimeError('Addee collided with extant file: %s, %s' % (
+                path, self.pathFromHexDigest(digest)))
+
+    def _place(self, fdo_name, digest, size, durability = None):
+        # Move the finished temporary file into place or drop it if the
+        # object's already there.  durability overrides the hashdir's.
+        if durability is None: durability = self.durability
+        self._ensure_fanout_dir(digest, self.fanout)
+
+        targ = os.path.join(self.rootdir,
+            get_path_from_hexdigest(digest, *self.fanout))
+        published = False
+        if not self._has_stored(digest):
+            # The content has to be on disk before the name is so that a
+            # crash can't leave an empty object under a valid digest.
+            if 'none' != durability: _fsync_path(fdo_name)
+            try:
+                published = _publish(fdo_name, targ)
+            except OSError, e:
+                # A reshard can clear out a directory we think is there.
+                if errno.ENOENT != e.errno or not os.path.exists(fdo_name):
+                    raise
+                self._dirs.clear()
+                self._ensure_fanout_dir(digest, self.fanout)
+                published = _publish(fdo_name, targ)
+        if published:
+            self._note_added(digest, size, targ)
+            if 'object' == durability or (
+                    'group' == durability and not self._deferring()):
+                self._sync_dirs([digest])
+        else:
+            # Either it was there all along or another writer beat us to it.
+            self._check_collision(fdo_name, digest, size,
+                self.codec is not None)
+            os.unlink(fdo_name)
+            self._freshen(digest)
+
+    @contextlib.contextmanager
+    def _inflight(self, digest):
+        # Hold the lock on digest for the block if adds are to take them.
+        if not self.lock_inflight:
+            yield
+            return
+        path = self._meta_path('locks', digest)
+        while True:
+            try:
+                fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+            except OSError, e:
+                if errno.ENOENT != e.errno: raise
+                _make_dir(self._meta_path())
+                _make_dir(self._meta_path('locks'))
+                continue
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                # The last holder unlinks the file on the way out so the
+                # lock only counts if the file's still the one at path.
+                st, fst = os.stat(path), os.fstat(fd)
+                if (st.st_dev, st.st_ino) == (fst.st_dev, fst.st_ino): break
+            except OSError, e:
+                if errno.ENOENT != e.errno:
+                    os.close(fd)
+                    raise
+            os.close(fd)
+        try:
+            yield
+        finally:
+            # The object's in place (or the add failed) so whoever's next
+            # finds out for itself.
+            try:
+                os.unlink(path)
+            finally:
+                os.close(fd)
+
+    def _deferring(self):
+        return getattr(self._local, 'defer_dir_syncs', False)
+
+    @contextlib.contextmanager
+    def _deferred_dir_syncs(self):
+        # Group-committed adds made by this thread in the block leave the
+        # flushing of directories to whoever's committing the group.
+        prev = self._deferring()
+        self._local.defer_dir_syncs = True
+        try:
+            yield
+        finally:
+            self._local.defer_dir_syncs = prev
+
+    def _sync_dirs(self, digests, manifests = ()):
+        # Flush each directory that the objects (and manifests) for the
+        # given digests were moved into, as well as the directories above
+        # them that might have been made for them, once.
+        depth, width = self.fanout
+        dirs = set([self.rootdir])
+        for digest in digests:
+            for i in xrange(1, depth + 1):
+                dirs.add(os.path.join(self.rootdir,
+                    get_dir_name_from_hexdigest(digest, i, width)))
+        if manifests:
+            dirs.add(self._meta_path())
+            dirs.add(self._meta_path('manifests'))
+            for digest in manifests:
+                dirs.add(os.path.dirname(self._manifest_path(digest)))
+        for d in sorted(dirs): _fsync_path(d)
+
+    def _pick_up_meta(self):
+        # Start keeping up an index, Bloom filter or stats that another
+        # HashDir made after this one was opened.
+        if self._index is None and os.path.exists(self._meta_path('index')):
+            with self._meta_lock:
+                if self._index is None:
+                    self._index = _DigestIndex(self._meta_path('index'))
+        if self._bloom is None and os.path.exists(self._meta_path('bloom')):
+            with self._meta_lock:
+                if self._bloom is None:
+                    self._bloom = _BloomFilter(self._meta_path('bloom'))
+        if self._stats is None and os.path.exists(self._meta_path('stats')):
+            with self._meta_lock:
+                if self._stats is None:
+                    self._stats = _StoreStats(self._meta_path('stats'))
+
+    def _note_added(self, digest, size, path, logical = None):
+        # Bring the index and the like up to date with a new object of size
+        # bytes that's stored at path.  The stats count logical bytes for
+        # it, which default to size.
+        if logical is None: logical = size
+        self._pick_up_meta()
+        if self._index is not None and self._index.get(digest) is None:
+            self._index.add(digest, size)
+        if self._bloom is not None: self._bloom.add(digest)
+        if self._stats is not None:
+            self._stats.update(1, logical, os.stat(path).st_size)
+
+    def _note_removed(self, digest, size, physical):
+        # The Bloom filter can't forget digests and so just gets a little
+        # less selective until it's rebuilt.
+        self._pick_up_meta()
+        if self._index is not None and self._index.get(digest) is not None:
+            self._index.remove(digest)
+        if self._stats is not None: self._stats.update(-1, size, physical)
+
+    def _freshen(self, digest):
+        # Bump the mtime of the extant object for digest that an add found
+        # so that a concurrent gc() counts it as recent and leaves it be.
+        # This is best effort; an object that's gone has nothing to bump.
+        touch = lambda path: os.utime(path, None) or True
+        try:
+            if self._find_loose(digest, touch): return
+            found = self._find_packed(digest)
+            touch(found[0].pack_path if found is not None
+                else self._manifest_path(digest))
+        except OSError:
+            pass
+
+    def _new_hash(self, algos = ()):
+        return _MultiHash([self.algo] + [a for a in algos if a != self.algo])
+
+    def _cache_put(self, st, fhash):
+        for algo, digest in fhash.hexdigests().iteritems():
+            self.hash_cache.put(st, algo, digest)
+
+    def _add_mapped(self, fi, fhash):
+        # Hash the file straight out of the page cache and only bring its
+        # content into the hashdir if it's new.  Return None if fi isn't
+        # worth the bother so that the caller falls back to the usual loop.
+        st = os.fstat(fi.fileno())
+        if not stat.S_ISREG(st.st_mode) or st.st_size < self._mmap_threshold:
+            return None
+
+        size, chunk = st.st_size, self._mmap_chunk
+        mm = mmap.mmap(fi.fileno(), 0, access = mmap.ACCESS_READ)
+        try:
+            for off in xrange(0, size, chunk):
+                fhash.update(buffer(mm, off, chunk))
+            digest = fhash.hexdigest()
+            if self.hash_cache is not None: self._cache_put(st, fhash)
+
+            with self._inflight(digest):
+                if self._has_stored(digest):
+                    self._check_collision(fi.name, digest, size)
+                    self._freshen(digest)
+                    return digest
+                self._copy_mapped(fi, mm, digest, size)
+        finally:
+            mm.close()
+
+        return digest
+
+    def _copy_mapped(self, fi, mm, digest, size):
+        # Bring the content of the file fi, which is mapped by mm, into
+        # the hashdir as the object for digest.
+        chunk = self._mmap_chunk
+        fdo_name = None
+        if self.codec is not None:
+            w = _ObjectWriter(self.rootdir, self.codec)
+            try:
+                for off in xrange(0, size, chunk):
+                    w.write(buffer(mm, off, chunk))
+            except:
+                w.abort()
+                raise
+            fdo_name = w.close()
+        elif self.link and hasattr(os, 'link'):
+            fdo_name = tempfile.mktemp(dir = self.rootdir)
+            try:
+                os.link(fi.name, fdo_name)
+            except OSError:
+                fdo_name = None
+        if fdo_name is None:
+            fdo, fdo_name = tempfile.mkstemp(dir = self.rootdir)
+            try:
+                if not _reflink(fi.fileno(), fdo):
+                    for off in xrange(0, size, chunk):
+                        _write_all(fdo, buffer(mm, off, chunk))
+            finally:
+                os.close(fdo)
+
+        self._place(fdo_name, digest, size)
+
+    def _cached_digests(self, addee, fhash):
+        # Return the digests of the file addee if the hash cache knows them
+        # all and the hashdir has its object.
+        if self.hash_cache is None or type(addee) not in (str, unicode):
+            return None
+        st = os.stat(addee)
+        digests = {}
+        for algo in fhash.algos:
+            digests[algo] = self.hash_cache.get(addee, algo, st)
+            if digests[algo] is None: return None
+        if not self._has_stored(digests[self.algo]): return None
+        self._freshen(digests[self.algo])
+        return digests
 
     def addFile(self, addee):
         '''Add addee to the hashdir and return the hex digest thereof.'''
-        return add_file(addee, self.rootdir, self.rename)
+        return self._add(addee, self._new_hash())[self.algo]
+
+    def add_file_digests(self, addee, algos):
+        '''
+        Add addee to the hashdir and return a dict mapping the name of each
+        hashlib algorithm in algos, as well as that of the hashdir, to the
+        hex digest of addee made with it.  The digests are all made in the
+        same pass over addee.
+        '''
+        return self._add(addee, self._new_hash(algos))
+
+    def _add(self, addee, fhash):
+        if not self.rename:
+            digests = self._cached_digests(addee, fhash)
+            if digests is not None: return digests
+
+        fi = w = None
+        st = None
+        is_path = type(addee) in (str, unicode)
+        # A compressing hashdir can't take the addee as is.
+        rename_addee = is_path and self.rename and self.codec is None
+        try:
+            if is_path:
+                fi = open(addee, 'rb')
+                if self.hash_cache is not None: st = os.fstat(fi.fileno())
+                if not self.rename:
+                    if self._add_mapped(fi, fhash) is not None:
+                        return fhash.hexdigests()
+            else:
+                fi = addee
+
+            if not rename_addee: w = _ObjectWriter(self.rootdir, self.codec)
+
+            sz = io.DEFAULT_BUFFER_SIZE
+            size = 0
+            while True:
+                buf = fi.read(sz)
+                if w is not None: w.write(buf)
+                fhash.update(buf)
+                size += len(buf)
+                if len(buf) < sz: break
+
+            fdo_name = w.close() if w is not None else addee
+            w = None
+        except:
+            if w is not None: w.abort()
+            raise
+        finally:
+            if fi is not None and id(fi) != id(addee): fi.close()
+
+        digest = fhash.hexdigest()
+        if st is not None and not self.rename: self._cache_put(st, fhash)
+        self._place(fdo_name, digest, size)
+        if is_path and self.rename and not rename_addee: os.unlink(addee)
+
+        return fhash.hexdigests()
+
+    def _write_buffer(self, buf):
+        # Write buf to a temporary file in one go and return its name.
+        w = _ObjectWriter(self.rootdir, self.codec)
+        try:
+            w.write(buf)
+        except:
+            w.abort()
+            raise
+        return w.close()
+
+    def add_bytes(self, buf):
+        '''
+        Add the content of buf, which can be a str, buffer, bytearray or
+        memoryview, and return its hex digest.  buf is hashed in place and
+        nothing is written if the hashdir already has it.  Unlike
+        addFile(), the extant object isn't read back to check for a
+        collision so that adding duplicate content stays cheap.
+        '''
+        buf = _as_buffer(buf)
+        digest = hashlib.new(self.algo, buf).hexdigest()
+        if self._has_stored(digest):
+            self._freshen(digest)
+            return digest
+        with self._inflight(digest):
+            if self._has_stored(digest):
+                self._freshen(digest)
+            else:
+                self._place(self._write_buffer(buf), digest, len(buf))
+        return digest
+
+    def add_buffers(self, buffers, fsync = None):
+        '''
+        Add the content of each of buffers like add_bytes() and return the
+        list of their hex digests.  The batch is made durable as set by the
+        hashdir's durability unless fsync is given.  If it's True, then the
+        batch is group committed regardless and if it's False, then nothing
+        is flushed.
+        '''
+        durability = self.durability
+        if fsync is not None: durability = 'group' if fsync else 'none'
+        digests, pending, seen = [], [], set()
+        try:
+            for buf in buffers:
+                buf = _as_buffer(buf)
+                digest = hashlib.new(self.algo, buf).hexdigest()
+                digests.append(digest)
+                if digest in seen: continue
+                seen.add(digest)
+                if self._has_stored(digest):
+                    self._freshen(digest)
+                    continue
+                pending.append((self._write_buffer(buf), digest, len(buf)))
+        except:
+            for name, digest, size in pending: os.unlink(name)
+            raise
+
+        with self._deferred_dir_syncs():
+            for i, (name, digest, size) in enumerate(pending):
+                try:
+                    self._place(name, digest, size, durability)
+                except:
+                    for name, digest, size in pending[i + 1:]:
+                        os.unlink(name)
+                    raise
+        if 'group' == durability and pending:
+            self._sync_dirs([e[1] for e in pending])
+
+        return digests
+
+    def add_chunked(self, addee):
+        '''
+        Add addee to the hashdir in content-defined chunks and return the
+        hex digest of its whole content.  Each chunk is stored as an object
+        of its own and a manifest listing the chunks is kept under the
+        whole digest.  Content shared with other chunked addees, e.g.,
+        disk images that only differ in a few sectors, is stored once.
+        openFileFromHexDigest() reassembles the content transparently.
+        '''
+        fhash = self._new_hash()
+        digests = self._cached_digests(addee, fhash)
+        if digests is not None: return digests[self.algo]
+
+        fi = open(addee, 'rb') if type(addee) in (str, unicode) else addee
+        st = os.fstat(fi.fileno()) if id(fi) != id(addee) else None
+        try:
+            entries, size = [], 0
+            with self._deferred_dir_syncs():
+                for chunk in _content_defined_chunks(fi, self._chunk_min,
+                        self._chunk_avg, self._chunk_max):
+                    fhash.update(chunk)
+                    entries.append((self.add_bytes(chunk), len(chunk)))
+                    size += len(chunk)
+        finally:
+            if id(fi) != id(addee): fi.close()
+
+        digest = fhash.hexdigest()
+        if st is not None and self.hash_cache is not None:
+            self._cache_put(st, fhash)
+        if not self._has_stored(digest) and self._write_manifest(digest,
+                entries):
+            # The content's bytes are already counted in the stats by way of
+            # its chunks.
+            self._note_added(digest, size, self._manifest_path(digest), 0)
+            # The chunks are committed as a group along with the manifest.
+            if 'none' != self.durability:
+                self._sync_dirs([e[0] for e in entries], [digest])
+        else:
+            self._freshen(digest)
+
+        return digest
+
+    def _add_file_caught(self, addee):
+        # Exceptions are handed back instead of raised so that one bad
+        # addee doesn't take the rest of a batch down with it.  The batch
+        # is group committed by add_files().
+        try:
+            with self._deferred_dir_syncs():
+                return self.addFile(addee), None
+        except Exception, e:
+            return None, e
+
+    def add_files(self, addees, workers = None, processes = None):
+        '''
+        Add each of addees to the hashdir using a pool of workers.  Return a
+        tuple (digests, failures) where digests holds the hex digests in the
+        same order as addees (None for addees that couldn't be added) and
+        failures is a list of (addee, exception) tuples.  A process pool can
+        only be given file names.  With group durability, the directories
+        that the batch's objects went into are flushed once the whole
+        batch is in place and before this returns.
+        '''
+        if workers is None: workers = self.workers
+        if workers is None: workers = multiprocessing.cpu_count()
+        if processes is None: processes = self.processes
+
+        addees = list(addees)
+        if workers <= 1 or len(addees) <= 1:
+            results = map(self._add_file_caught, addees)
+        else:
+            if processes:
+                pool = multiprocessing.Pool(min(workers, len(addees)))
+                fn = _add_file_job
+                jobs = [(self._job_args(), a) for a in addees]
+            else:
+                pool = multiprocessing.pool.ThreadPool(
+                    min(workers, len(addees)))
+                fn, jobs = self._add_file_caught, addees
+            try:
+                chunk = max(1, min(64, len(jobs) // (4 * workers)))
+                results = list(pool.imap(fn, jobs, chunk))
+            finally:
+                pool.close()
+                pool.join()
+
+        digests, failures = [], []
+        for addee, (digest, error) in zip(addees, results):
+            digests.append(digest)
+            if error is not None: failures.append((addee, error))
+        if 'group' == self.durability:
+            self._sync_dirs([d for d in digests if d is not None])
+
+        return digests, failures
+
+    def add_tree(self, path, workers = None, processes = None):
+        '''
+        Add every file under path to the hashdir via add_files().  Return a
+        tuple (paths, digests, failures) where paths is the order in which
+        the files were added and the rest is as for add_files().
+        '''
+        paths = list(_tree_files(path, self.rootdir))
+        digests, failures = self.add_files(paths, workers, processes)
+        return paths, digests, failures
+
+    def _iter_fanout_dirs(self, base = None, fanout = None):
+        # Yield (digest prefix, path) for each of the bottommost fan-out
+        # directories under base.
+        if base is None: base = self.rootdir
+        if fanout is None: fanout = self.fanout
+        depth, width = fanout
+        if 0 == depth:
+            if os.path.isdir(base or '.'): yield '', base
+            return
+        if not os.path.isdir(base or '.'): return
+        for name in sorted(os.listdir(base or '.')):
+            if len(name) != width or not _is_hex(name): continue
+            path = os.path.join(base, name)
+            if not os.path.isdir(path): continue
+            for prefix, sub in self._iter_fanout_dirs(path,
+                    (depth - 1, width)):
+                yield name + prefix, sub
+
+    def _iter_fanout(self, base = None, fanout = None):
+        if fanout is None: fanout = self.fanout
+        name_len = self._digest_len - fanout[0] * fanout[1]
+        for prefix, dpath in self._iter_fanout_dirs(base, fanout):
+            for fname in sorted(os.listdir(dpath)):
+                if len(fname) == name_len and _is_hex(fname):
+                    yield prefix + fname, os.path.join(dpath, fname)
+
+    def iter_objects(self):
+        '''Yield (digest, path) for every loose object in the hashdir.'''
+        for fanout in self._fanouts:
+            for digest, path in self._iter_fanout(fanout = fanout):
+                yield digest, path
+
+    def iter_manifests(self):
+        '''Yield (digest, chunk list) for every chunked addee.'''
+        for digest, path in self._iter_fanout(self._meta_path('manifests'),
+                (1, 2)):
+            entries = self._read_manifest(digest)
+            if entries is not None: yield digest, entries
+
+    def iter_packed(self):
+        '''Yield (digest, length) for every packed object in the hashdir.'''
+        self._refresh_packs()
+        for path in sorted(self._packs):
+            for digest, offset, length in self._packs[path].entries():
+                yield digest, length
+
+    def rebuild_index(self):
+        '''
+        (Re)generate the digest index by walking the hashdir.  What other
+        HashDirs add to an extant index during the walk is kept; an add
+        that races the very first build can be missed.
+        '''
+        _make_dir(self._meta_path())
+        self._pick_up_meta()
+        mark = self._index.mark() if self._index is not None else None
+        sizes = {}
+        if self.codec is None:
+            for digest, length in self.iter_packed():
+                sizes[digest] = length
+            for digest, path in self.iter_objects():
+                sizes[digest] = os.stat(path).st_size
+        else:
+            for digest in self.iter_digests():
+                if digest in sizes: continue
+                try:
+                    raw = self._open_raw(digest)
+                except IOError, e:
+                    if errno.ENOENT != e.errno: raise
+                    continue
+                with raw:
+                    sizes[digest] = self._logical_size(raw)
+        for digest, entries in self.iter_manifests():
+            sizes.setdefault(digest, sum([e[1] for e in entries]))
+        if self._index is None:
+            self._index = _DigestIndex(self._meta_path('index'))
+        self._index.reset(sizes, mark)
+
+    def has_digest(self, digest):
+        '''Return True if the hashdir holds the object for digest.'''
+        return self._has_object(digest)
+
+    def have_digests(self, digests):
+        '''Return the set of the given digests that the hashdir holds.'''
+        return set([d for d in digests if self._has_object(d)])
+
+    def contains_many(self, digests):
+        '''
+        Return the set of the given digests that the hashdir holds.  With
+        a Bloom filter, only the digests that it thinks might be present
+        are looked for so that absent ones are ruled out in memory.
+        '''
+        self._pick_up_meta()
+        if self._bloom is None: return self.have_digests(digests)
+        self._bloom.refresh()
+        might = self._bloom.might_contain
+        return self.have_digests([d for d in digests if might(d)])
+
+    def _bucket_digests(self, prefix = None):
+        buckets = {}
+        if self._index is not None:
+            self._index.refresh()
+            digests = self._index.sizes.keys()
+        else:
+            digests = self.iter_digests()
+        for digest in digests:
+            if prefix is None or digest.startswith(prefix):
+                buckets.setdefault(digest[:2], set()).add(digest)
+        return dict([(k, sorted(v)) for k, v in buckets.iteritems()])
+
+    def bucket_summaries(self):
+        '''
+        Return a dict that maps the first two characters of the hashdir's
+        digests to a digest of the sorted digests that start with them.
+        Two hashdirs with the same summary for a bucket hold the same
+        objects in it.  The buckets are remembered for bucket_digests() for
+        _buckets_ttl seconds.
+        '''
+        self._buckets = self._bucket_digests()
+        self._buckets_taken = time.time()
+        return dict([(k, hashlib.sha1('\n'.join(v)).hexdigest())
+            for k, v in self._buckets.iteritems()])
+
+    def bucket_digests(self, prefix):
+        '''
+        Return the sorted digests that start with the two-char prefix.
+        They come from the last bucket_summaries() if that was recent
+        enough so that both describe the same state of the hashdir.
+        '''
+        buckets = getattr(self, '_buckets', None)
+        if buckets is None or (
+                time.time() - self._buckets_taken > self._buckets_ttl):
+            self._buckets = None
+            buckets = self._bucket_digests(prefix)
+        return buckets.get(prefix, [])
+
+    def rebuild_bloom(self, false_positive_rate = 0.01, capacity = None):
+        '''
+        (Re)build the Bloom filter from the hashdir's digests.  It's sized
+        for capacity digests at the given false positive rate; capacity
+        defaults to twice the current number of digests.
+        '''
+        if capacity is None:
+            capacity = 2 * sum([1 for d in self.iter_digests()])
+        capacity = max(capacity, 1 << 16)
+        ln2 = math.log(2)
+        bits = -capacity * math.log(false_positive_rate) / (ln2 * ln2)
+        log2_bits = max(16, min(40, int(math.ceil(math.log(bits, 2)))))
+        hashes = max(1, int(round((1 << log2_bits) * ln2 / capacity)))
+
+        _make_dir(self._meta_path())
+        fd, name = tempfile.mkstemp(dir = self._meta_path())
+        os.close(fd)
+        _BloomFilter.create(name, log2_bits, min(hashes, 32))
+        bloom = _BloomFilter(name)
+        bloom.path = self._meta_path('bloom')
+        # Adds to the old filter wait from before the digests are listed
+        # until the new filter has replaced it, and then go to the new one.
+        # Nobody else can see the new filter yet so it needs no locking.
+        self._pick_up_meta()
+        old = self._bloom
+        if old is not None:
+            old._lock.acquire()
+            if old._replaced(): old._map()
+            if fcntl is not None: fcntl.flock(old._f, fcntl.LOCK_EX)
+        try:
+            for digest in self.iter_digests(): bloom.set(digest)
+            os.rename(name, bloom.path)
+        finally:
+            if old is not None:
+                if fcntl is not None: fcntl.flock(old._f, fcntl.LOCK_UN)
+                old._lock.release()
+        self._bloom = bloom
+        if old is not None: old.close()
+
+    def stats(self):
+        '''
+        Return a pu.utils.DataContainer with the running totals of the
+        hashdir: the number of objects, their logical (uncompressed) and
+        physical (on disk) bytes and a histogram of their logical sizes in
+        which entry i counts the objects of at least 2**(i - 1) and less
+        than 2**i bytes.  The manifest of a chunked addee counts as an
+        object with no logical bytes, since its content is counted by way
+        of its chunks, and the physical size of the manifest itself.
+        Return None if the hashdir doesn't keep stats.
+        An IOError is raised if the stats were damaged, e.g., by a crash
+        in the middle of an update; rebuild_stats() repairs them.
+        '''
+        if self._stats is None: return None
+        return self._stats.read()
+
+    def rebuild_stats(self):
+        '''
+        (Re)generate the hashdir's stats by walking it.  Adds and removals
+        made by others while this runs might not be counted.
+        '''
+        totals = [0] * (3 + _StoreStats._buckets)
+        seen = set()
+        def count(digest, logical, physical):
+            if digest in seen: return
+            seen.add(digest)
+            totals[0] += 1
+            totals[1] += logical
+            totals[2] += physical
+            totals[3 + _StoreStats.bucket(logical)] += 1
+
+        for digest, path in self.iter_objects():
+            try:
+                with open(path, 'rb') as raw:
+                    physical = os.fstat(raw.fileno()).st_size
+                    count(digest, physical if self.codec is None
+                        else self._logical_size(raw), physical)
+            except IOError, e:
+                if errno.ENOENT != e.errno: raise
+        self._refresh_packs()
+        for path in sorted(self._packs):
+            pack = self._packs[path]
+            for digest, offset, length in pack.entries():
+                if self.codec is None:
+                    count(digest, length, length)
+                else:
+                    with pack.open(offset, length) as raw:
+                        count(digest, self._logical_size(raw), length)
+        for digest, entries in self.iter_manifests():
+            count(digest, 0, os.path.getsize(self._manifest_path(digest)))
+
+        _make_dir(self._meta_path())
+        fd, name = tempfile.mkstemp(dir = self._meta_path())
+        os.close(fd)
+        _StoreStats.create(name, totals)
+        os.rename(name, self._meta_path('stats'))
+        if self._stats is not None: self._stats.close()
+        self._stats = _StoreStats(self._meta_path('stats'))
+
+    def iter_digests(self):
+        '''
+        Yield the digest of every object in the hashdir.  A digest can show
+        up twice if its object is caught in the middle of being packed.
+        '''
+        for digest, length in self.iter_packed():
+            yield digest
+        for digest, path in self.iter_objects():
+            yield digest
+        for digest, entries in self.iter_manifests():
+            yield digest
+
+    def size_of(self, digest):
+        '''
+        Return the (uncompressed) size of the object for digest or None if
+        it's absent.
+        '''
+        if self._index is not None: return self._index.get(digest)
+        return self._size_on_disk(digest)
+
+    def _size_on_disk(self, digest):
+        # Like size_of() but without the index, which can lag behind what
+        # other writers have just put in place.
+        size = self._stored_size(digest)
+        if size is None:
+            entries = self._read_manifest(digest)
+            if entries is not None: size = sum([e[1] for e in entries])
+        return size
+
+    def _stored_size(self, digest):
+        if self.codec is not None:
+            try:
+                raw = self._open_raw(digest)
+            except IOError, e:
+                if errno.ENOENT != e.errno: raise
+                return None
+            with raw:
+                return self._logical_size(raw)
+        st = self._find_loose(digest, os.stat)
+        if st is not None: return st.st_size
+        found = self._find_packed(digest)
+        return found[2] if found is not None else None
+
+    def repack(self, threshold = None):
+        '''
+        Move the loose objects smaller than threshold bytes into packs and
+        return how many were moved.  Packed objects are read back via
+        openFileFromHexDigest() like any other.
+        '''
+        if threshold is None: threshold = self._pack_threshold
+        _make_dir(self._meta_path())
+        packs_dir = self._meta_path('packs')
+        _make_dir(packs_dir)
+
+        def finish(writer, paths):
+            writer.finish()
+            # The loose copies can only go once the pack is in place.
+            for path in paths: os.unlink(path)
+            return len(paths)
+
+        moved, writer, paths = 0, None, []
+        try:
+            for digest, path in self.iter_objects():
+                try:
+                    with open(path, 'rb') as f:
+                        buf = f.read(threshold)
+                except IOError, e:
+                    if errno.ENOENT != e.errno: raise
+                    continue
+                if len(buf) >= threshold: continue
+                if writer is not None and (
+                        writer.size + len(buf) > self._pack_max_size):
+                    moved += finish(writer, paths)
+                    writer = None
+                if writer is None: writer, paths = _PackWriter(packs_dir), []
+                writer.add(digest, buf)
+                paths.append(path)
+            if writer is not None: moved += finish(writer, paths)
+        except:
+            if writer is not None: writer.abort()
+            raise
+
+        return moved
+
+    def _check_object(self, digest):
+        # Rehash the object for digest a bounded buffer at a time.  Return
+        # None if it's fine or what's wrong with it otherwise.
+        fhash, size = self._new_hash(), 0
+        try:
+            expected = self.size_of(digest)
+            with self.openFileFromHexDigest(digest) as f:
+                for buf in iter(lambda: f.read(self._mmap_chunk), ''):
+                    fhash.update(buf)
+                    size += len(buf)
+        except IOError, e:
+            if errno.ENOENT == e.errno: return 'missing'
+            return 'truncated' if errno.EIO == e.errno else 'corrupt'
+        except Exception:
+            return 'corrupt'
+        if fhash.hexdigest() == digest: return None
+        if (expected is not None and size < expected) or (
+                0 == size and digest != self._new_hash().hexdigest()):
+            return 'truncated'
+        return 'corrupt'
+
+    def _check_object_job(self, digest):
+        return digest, self._check_object(digest)
+
+    def _stray_files(self, age):
+        # Temporary files left behind by adds, packs and the like that
+        # didn't finish.
+        dirs = [self.rootdir, self._meta_path(), self._meta_path('packs')]
+        dirs.extend([p for n, p in self._iter_fanout_dirs(
+            self._meta_path('manifests'), (1, 2))])
+        cutoff = time.time() - age
+        for d in dirs:
+            if not os.path.isdir(d or '.'): continue
+            for name in sorted(os.listdir(d or '.')):
+                if not name.startswith(tempfile.gettempprefix()): continue
+                path = os.path.join(d, name)
+                try:
+                    if os.stat(path).st_mtime < cutoff: yield path
+                except OSError:
+                    pass
+
+    def verify(self, resume = False, time_limit = None, workers = None):
+        '''
+        Check that the objects of the hashdir still hash to their digests.
+        Objects are rehashed across a pool of workers a bounded buffer at
+        a time.  The hashdir is worked through one fan-out directory (or
+        pack) at a time and the last one finished is recorded in
+        .hashdir/verify-state.  If resume is True, then verification picks
+        up after it.  If time_limit is given, then verification stops once
+        that many seconds have gone by and a directory is finished.
+
+        Return a pu.utils.DataContainer with lists of the digests found to
+        be corrupt, truncated or missing (chunks of chunked addees), a list
+        of stray temporary files that are more than an hour old, the
+        number of objects checked and whether the hashdir was gone
+        through to the end (complete).
+        '''
+        if workers is None: workers = self.workers
+        if workers is None: workers = multiprocessing.cpu_count()
+        start = time.time()
+        result = DataContainer(corrupt = [], truncated = [], missing = [],
+            stray = list(self._stray_files(self._stray_age)), checked = 0,
+            complete = False)
+
+        state_path = self._meta_path('verify-state')
+        done = ''
+        if resume and os.path.exists(state_path):
+            with open(state_path, 'rb') as f:
+                done = f.read().rstrip('\n')
+
+        # Units of work are keyed so that they sort in the order they're
+        # done in: fan-out directories, then packs and then manifests.
+        self._refresh_packs()
+        units = [('0 ' + prefix, (prefix, path)) for fanout in self._fanouts
+            for prefix, path in self._iter_fanout_dirs(fanout = fanout)]
+        units.extend([('1 ' + os.path.basename(p), self._packs[p])
+            for p in sorted(self._packs)])
+        units.append(('2 manifests', None))
+
+        def digests_of(unit):
+            if isinstance(unit, _Pack):
+                return [e[0] for e in unit.entries()]
+            prefix, path = unit
+            return [prefix + n for n in sorted(os.listdir(path))
+                if len(prefix + n) == self._digest_len and _is_hex(n)]
+
+        pool = multiprocessing.pool.ThreadPool(max(1, workers))
+        try:
+            for key, unit in units:
+                if key <= done: continue
+                if unit is None:
+                    for digest, entries in self.iter_manifests():
+                        result.checked += 1
+                        result.missing.extend([d for d, length in entries
+                            if not self._has_object(d)])
+                else:
+                    for digest, status in pool.imap(self._check_object_job,
+                            digests_of(unit), 16):
+                        result.checked += 1
+                        if status is not None:
+                            result[status].append(digest)
+
+                _make_dir(self._meta_path())
+                with open(state_path, 'wb') as f:
+                    f.write(key + '\n')
+                if time_limit is not None and (
+                        time.time() - start > time_limit):
+                    break
+            else:
+                result.complete = True
+                if os.path.exists(state_path): os.unlink(state_path)
+        finally:
+            pool.close()
+            pool.join()
+
+        return result
+
+    def reshard(self, depth, width):
+        '''
+        Change the fan-out of the hashdir to depth levels of directories
+        named by width digest characters each and return the number of
+        objects moved.  Objects are moved one at a time and the hashdir
+        stays usable throughout; other HashDirs on the same root look in
+        both layouts until the move is done.  An interrupted reshard is
+        finished by calling reshard() again.  Writers in other processes
+        that were started before the reshard should be restarted after it
+        so that they don't keep adding to the old layout.
+        '''
+        self._check_fanout((depth, width), self.algo)
+        self._reload_config()
+        c = self._config
+        old = self._fanouts[0]
+        if (depth, width) == self.fanout and 1 == len(self._fanouts):
+            return 0
+        c.prev_fanout_depth, c.prev_fanout_width = old
+        c.fanout_depth, c.fanout_width = depth, width
+        self._save_config()
+        self._apply_config()
+
+        moved = 0
+        # A second pass picks up objects added to the old layout by
+        # writers that hadn't noticed the reshard yet.
+        for i in xrange(2):
+            for digest, path in list(self._iter_fanout(fanout = old)):
+                self._ensure_fanout_dir(digest, self.fanout)
+                try:
+                    os.rename(path, os.path.join(self.rootdir,
+                        get_path_from_hexdigest(digest, depth, width)))
+                except OSError, e:
+                    if errno.ENOENT != e.errno: raise
+                    continue
+                moved += 1
+
+        c.prev_fanout_depth, c.prev_fanout_width = 0, 0
+        self._save_config()
+        self._apply_config()
+
+        # Clear out the emptied directories of the old layout; rmdir()
+        # leaves the ones that the new layout still uses.
+        for level in xrange(old[0], 0, -1):
+            for prefix, path in list(self._iter_fanout_dirs(
+                    fanout = (level, old[1]))):
+                try:
+                    os.rmdir(path)
+                    self._dirs.discard(path)
+                except OSError:
+                    pass
+
+        return moved
+
+    def _ref_path(self, name):
+        if (not name or name.startswith('.') or '/' in name
+                or os.sep in name):
+            raise ValueError('Invalid ref name: %r' % (name,))
+        return self._meta_path('refs', name)
+
+    def set_ref(self, name, digests):
+        '''
+        Make the ref name list the given digests, replacing what it listed
+        before.  Refs are the roots that gc() keeps objects reachable from.
+        The objects should have been added or refreshed by an add within
+        the gc() grace period or already be reachable from another ref so
+        that a concurrent gc() doesn't sweep them first.
+        '''
+        path = self._ref_path(name)
+        _make_dir(self._meta_path())
+        _make_dir(self._meta_path('refs'))
+        fd, tmp = tempfile.mkstemp(dir = self._meta_path('refs'))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for digest in digests:
+                    if len(digest) != self._digest_len or not _is_hex(digest):
+                        raise ValueError('Invalid digest: %r' % (digest,))
+                    f.write(digest.lower() + '\n')
+            os.rename(tmp, path)
+        except:
+            os.unlink(tmp)
+            raise
+
+    def iter_ref(self, name):
+        '''Yield the digests that the ref name lists.'''
+        with open(self._ref_path(name), 'rb') as f:
+            for ln in f:
+                ln = ln.strip()
+                if ln: yield ln
+
+    def delete_ref(self, name):
+        '''Remove the ref name so that what it listed can be collected.'''
+        os.unlink(self._ref_path(name))
+
+    def refs(self):
+        '''Return the sorted names of the hashdir's refs.'''
+        refs_dir = self._meta_path('refs')
+        if not os.path.isdir(refs_dir): return []
+        return sorted([n for n in os.listdir(refs_dir)
+            if not n.startswith(tempfile.gettempprefix())])
+
+    def _iter_reachable(self):
+        # Yield the digests listed by the refs along with the chunks of the
+        # chunked ones.  Duplicates are left to _sorted_unique().
+        for name in self.refs():
+            for digest in self.iter_ref(name):
+                if len(digest) != self._digest_len or not _is_hex(digest):
+                    continue
+                yield digest
+                for chunk, length in self._read_manifest(digest) or ():
+                    yield chunk
+
+    def _sweep_dir(self, prefix, path, live, cutoff, manifests = False):
+        # Remove the objects (or manifests) in the directory path that
+        # aren't live and haven't been touched since cutoff.
+        removed = recent = 0
+        for name in sorted(os.listdir(path)):
+            digest = prefix + name
+            if len(digest) != self._digest_len or not _is_hex(name):
+                continue
+            if digest in live: continue
+            fpath = os.path.join(path, name)
+            try:
+                st = os.stat(fpath)
+                if st.st_mtime >= cutoff:
+                    recent += 1
+                    continue
+                size = st.st_size
+                if self._stats is not None:
+                    size = self._removed_size(digest, fpath, manifests)
+                os.unlink(fpath)
+            except EnvironmentError, e:
+                if errno.ENOENT != e.errno: raise
+                continue
+            removed += 1
+            self._note_removed(digest, size, st.st_size)
+        return removed, recent
+
+    def _removed_size(self, digest, path, manifest):
+        # Return the logical size of the object (or manifest) at path.
+        if manifest: return 0
+        if self.codec is None: return os.stat(path).st_size
+        with open(path, 'rb') as raw:
+            return self._logical_size(raw)
+
+    def _sweep_pack(self, pack, live, cutoff):
+        # Rewrite pack without the objects that aren't live.  A pack that
+        # was written or had an object refreshed since cutoff is left be.
+        entries = list(pack.entries())
+        dead = [e for e in entries if e[0] not in live]
+        if not dead: return 0, 0
+        if os.stat(pack.pack_path).st_mtime >= cutoff: return 0, len(dead)
+
+        if len(dead) < len(entries):
+            writer = _PackWriter(os.path.dirname(pack.idx_path))
+            try:
+                for digest, offset, length in entries:
+                    if digest not in live: continue
+                    with pack.open(offset, length) as f:
+                        writer.add(digest, f.read())
+                writer.finish()
+            except:
+                writer.abort()
+                raise
+        sizes = [length for digest, offset, length in dead]
+        if self.codec is not None and self._stats is not None:
+            for i, (digest, offset, length) in enumerate(dead):
+                with pack.open(offset, length) as raw:
+                    sizes[i] = self._logical_size(raw)
+        # The new pack's in place so the old one can go, .idx first so
+        # that readers stop finding it.
+        os.unlink(pack.idx_path)
+        os.unlink(pack.pack_path)
+        with self._packs_lock:
+            self._packs.pop(pack.idx_path, None)
+        for (digest, offset, length), size in zip(dead, sizes):
+            self._note_removed(digest, size, length)
+        return len(dead), 0
+
+    def _sweep_job(self, unit):
+        kind, args = unit
+        if 'pack' == kind: return self._sweep_pack(*args)
+        return self._sweep_dir(*args, manifests = 'manifest' == kind)
+
+    def gc(self, grace = None, workers = None):
+        '''
+        Remove the objects that can't be reached from any ref.  Chunked
+        addees reach their chunks.  The reachable digests are sorted on
+        disk so that only a bounded number of them are in memory at a time
+        however many there are.  The hashdir is then swept one fan-out
+        directory (or pack) at a time across a pool of workers.
+
+        Adds can go on during gc().  Objects that were added or found
+        already there by an add less than grace seconds (an hour by
+        default) before gc() started are left alone whether reachable or
+        not.  A pack with unreachable objects is rewritten without them
+        unless it's that recent.
+
+        Return a pu.utils.DataContainer with the number of reachable
+        digests (marked), the number of objects removed and the number
+        of unreachable ones kept because they were recent.
+        '''
+        if not os.path.isdir(self._meta_path('refs')):
+            raise ValueError('No refs to collect garbage by: ' + self.rootdir)
+        if grace is None: grace = self._gc_grace
+        if workers is None: workers = self.workers
+        if workers is None: workers = multiprocessing.cpu_count()
+        cutoff = time.time() - grace
+
+        live_path = _sorted_unique(self._iter_reachable(), self._meta_path(),
+            self._gc_run_len)
+        live = _SortedDigests(live_path, self._digest_len)
+        result = DataContainer(marked = live.count, removed = 0, recent = 0)
+        pool = multiprocessing.pool.ThreadPool(max(1, workers))
+        try:
+            self._refresh_packs()
+            units = [('loose', (prefix, path, live, cutoff))
+                for fanout in self._fanouts
+                    for prefix, path in self._iter_fanout_dirs(
+                        fanout = fanout)]
+            units.extend([('pack', (self._packs[p], live, cutoff))
+                for p in sorted(self._packs)])
+            units.extend([('manifest', (prefix, path, live, cutoff))
+                for prefix, path in self._iter_fanout_dirs(
+                    self._meta_path('manifests'), (1, 2))])
+            for removed, recent in pool.imap_unordered(self._sweep_job,
+                    units):
+                result.removed += removed
+                result.recent += recent
+        finally:
+            pool.close()
+            pool.join()
+            live.close()
+            os.unlink(live_path)
+
+        return result
 
     def pathFromHexDigest(self, digest):
         '''Get the path to the file associated with the given digest.'''
-        return os.path.join(self.rootdir, get_path_from_hexdigest(digest))
+        paths = self._loose_paths(digest)
+        if len(paths) > 1:
+            for path in paths:
+                if os.path.exists(path): return path
+        return paths[-1]
+
+    def openFileFromHexDigest(self, digest):
+        '''
+        Open the file associated with the given digest for reading.  A
+        packed object is returned as a read-only file-like view bounded to
+        the object.  The objects of a compressing hashdir are returned as a
+        file-like object that decompresses as it's read.
+        '''
+        try:
+            return self._decoded(self._open_raw(digest))
+        except IOError, e:
+            if errno.ENOENT != e.errno: raise
+        entries = self._read_manifest(digest)
+        if entries is None:
+            raise IOError(errno.ENOENT, 'No such object', digest)
+        return _ChunkedReader(self._manifest_path(digest), entries,
+            self.openFileFromHexDigest)
+
+    def _mapped(self, digest):
+        # Return (mmap, offset, length) locating the object for digest in a
+        # mapping or None if the object isn't stored as is, i.e., it's
+        # compressed or chunked.  The mappings of hot objects are kept in
+        # a least-recently-used cache; since objects never change, one
+        # that's been moved or removed since it was mapped still maps the
+        # right content.
+        with self._handles_lock:
+            handle = self._handles.pop(digest, None)
+            if handle is not None:
+                self._handles[digest] = handle
+                return handle
+        if self.codec is not None: return None
+
+        f = self._find_loose(digest, lambda path: open(path, 'rb'))
+        if f is not None:
+            with f:
+                length = os.fstat(f.fileno()).st_size
+                handle = (mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+                    if length else None, 0, length)
+        else:
+            found = self._find_packed(digest)
+            if found is None:
+                if os.path.exists(self._manifest_path(digest)): return None
+                raise IOError(errno.ENOENT, 'No such object', digest)
+            pack, offset, length = found
+            handle = (pack.mapping(), offset, length)
+
+        with self._handles_lock:
+            self._handles[digest] = handle
+            while len(self._handles) > self._handle_cache_size:
+                self._handles.popitem(last = False)
+        return handle
+
+    def read_range(self, digest, offset, length = None):
+        '''
+        Return the length bytes (or fewer at the end) of the object for
+        digest that start at offset.  If length is None, then the rest of
+        the object is returned.  Objects stored as is are read through a
+        cached mapping so that hot objects don't cost an open() per read.
+        '''
+        if offset < 0 or (length is not None and length < 0):
+            raise ValueError('Invalid range: %r, %r' % (offset, length))
+        handle = self._mapped(digest)
+        if handle is None:
+            with self.openFileFromHexDigest(digest) as f:
+                f.seek(offset)
+                return f.read(-1 if length is None else length)
+        mm, start, size = handle
+        end = size if length is None else min(size, offset + length)
+        if offset >= end: return ''
+        return mm[start + offset : start + end]
+
+    def map(self, digest):
+        '''
+        Return a read-only buffer of the content of the object for digest
+        that can be handed to struct, array and the like without a copy.
+        The buffer is a view of a mapping of the object that stays valid
+        for as long as the buffer is around.  The content of a compressed
+        or chunked object has to be put together first so that it's read
+        into memory instead.
+        '''
+        handle = self._mapped(digest)
+        if handle is None:
+            with self.openFileFromHexDigest(digest) as f:
+                return buffer(f.read())
+        mm, start, size = handle
+        if not size: return buffer('')
+        return buffer(mm, start, size)
+
+    def _open_raw(self, digest):
+        f = self._find_loose(digest, lambda path: open(path, 'rb'))
+        if f is not None: return f
+        for retry in (False, True):
+            found = self._find_packed(digest)
+            if found is None: break
+            pack, offset, length = found
+            try:
+                return pack.open(offset, length)
+            except IOError, e:
+                # The pack was rewritten by gc() and the object might have
+                # moved to another.
+                if retry or errno.ENOENT != e.errno: raise
+                self._refresh_packs()
+        raise IOError(errno.ENOENT, 'No such object', digest)
+
+class _ChunkReader(object):
+    '''
+    This is a file-like object over the strings that next_chunk() returns
+    until it returns ''.
+    '''
+    def __init__(self, next_chunk):
+        self._next = next_chunk
+        self._buf = ''
+        self._eof = False
+
+    def read(self, n = -1):
+        parts, have = [self._buf], len(self._buf)
+        while not self._eof and (n is None or n < 0 or have < n):
+            buf = self._next()
+            if not buf:
+                self._eof = True
+            else:
+                parts.append(buf)
+                have += len(buf)
+        buf = ''.join(parts)
+        if n is None or n < 0: n = len(buf)
+        self._buf = buf[n:]
+        return buf[:n]
+
+class _StreamedAdd(object):
+    '''
+    This is what AsyncHashDir.stream() returns.  Chunks given to write()
+    are hashed and stored by a worker as they arrive; write() blocks while
+    the worker is behind by more than the queue holds.
+    '''
+    def __init__(self, max_chunks):
+        self._queue = Queue.Queue(max_chunks)
+        self.result = None
+
+    def _next_chunk(self):
+        return self._queue.get()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if exc_info[0] is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, buf):
+        if buf: self._queue.put(str(buf))
+
+    def close(self):
+        '''Mark the end of the stream and return the AsyncResult.'''
+        self._queue.put('')
+        return self.result
+
+    def abort(self):
+        self._queue.put(None)
+
+class AsyncHashDir(object):
+    '''
+    This wraps a HashDir so that adds and reads run on a bounded pool of
+    worker threads instead of blocking the caller.  Calls return
+    multiprocessing AsyncResults that can be waited on or given a callback
+    that's called with the result.  At most max_pending operations are in
+    flight at once; submitting another blocks until one finishes.
+
+    stream() and read() jobs wait on the caller to write or read, so they
+    can't be queued behind each other for a worker.  They run on a pool of
+    their own that's as big as max_pending and so always has a thread for
+    them.
+    '''
+    def __init__(self, hashdir, workers = 4, max_pending = None):
+        self.hashdir = hashdir
+        if max_pending is None: max_pending = 2 * workers
+        self._max_pending = max_pending
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self._pool = multiprocessing.pool.ThreadPool(workers)
+        self._stream_pool = None
+        self._stream_pool_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        '''Wait for the operations in flight and stop the workers.'''
+        if self._pool is None: return
+        for pool in (self._pool, self._stream_pool):
+            if pool is None: continue
+            pool.close()
+            pool.join()
+        self._pool = self._stream_pool = None
+
+    def _streaming(self):
+        with self._stream_pool_lock:
+            if self._stream_pool is None:
+                self._stream_pool = multiprocessing.pool.ThreadPool(
+                    self._max_pending)
+            return self._stream_pool
+
+    def _submit(self, func, args, callback, pool = None):
+        self._pending.acquire()
+        def job():
+            try:
+                return func(*args)
+            finally:
+                self._pending.release()
+        try:
+            return (pool or self._pool).apply_async(job,
+                callback = callback)
+        except:
+            self._pending.release()
+            raise
+
+    def add(self, addee, callback = None):
+        '''
+        Add addee to the hashdir in the background.  Besides what addFile()
+        takes, addee can be an iterable of strings so that content can be
+        stored while it's still being produced.  The result is the hex
+        digest of addee.
+        '''
+        if not (isinstance(addee, basestring) or hasattr(addee, 'read')):
+            chunks = iter(addee)
+            def next_chunk():
+                try:
+                    return str(chunks.next())
+                except StopIteration:
+                    return ''
+            addee = _ChunkReader(next_chunk)
+        return self._submit(self.hashdir.addFile, (addee,), callback)
+
+    def stream(self, callback = None, max_chunks = 16):
+        '''
+        Return an object to write() the content to be added to as it
+        arrives.  Its close() returns the AsyncResult of the add.
+        '''
+        sa = _StreamedAdd(max_chunks)
+        def next_chunk():
+            buf = sa._next_chunk()
+            if buf is None: raise IOError(errno.EINTR, 'Add aborted')
+            return buf
+        sa.result = self._submit(self.hashdir.addFile,
+            (_ChunkReader(next_chunk),), callback, self._streaming())
+        return sa
+
+    def open(self, digest, callback = None):
+        '''Open the object for digest in the background.'''
+        return self._submit(self.hashdir.openFileFromHexDigest, (digest,),
+            callback)
+
+    def read(self, digest, chunk_size = 1 << 16, max_chunks = 4):
+        '''
+        Generate the content of the object for digest in chunks of at most
+        chunk_size bytes that a worker reads ahead by up to max_chunks.
+        '''
+        queue = Queue.Queue(max_chunks)
+        stop = threading.Event()
+        def reader():
+            try:
+                with self.hashdir.openFileFromHexDigest(digest) as f:
+                    while not stop.is_set():
+                        buf = f.read(chunk_size)
+                        queue.put((buf, None))
+                        if not buf: break
+            except Exception, e:
+                queue.put(('', e))
+        result = self._submit(reader, (), None, self._streaming())
+        try:
+            while True:
+                buf, e = queue.get()
+                if e is not None: raise e
+                if not buf: break
+                yield buf
+        finally:
+            stop.set()
+            # Let the worker past a full queue so that it notices the stop.
+            while not result.ready():
+                try:
+                    queue.get(timeout = 0.01)
+                except Queue.Empty:
+                    pass
+
+class _FramedReader(object):
+    '''
+    This reads content sent as frames of "<length>\\n<bytes>" ending with a
+    zero-length frame from f.  Reads are only short at the end.
+    '''
+    def __init__(self, f):
+        self._f = f
+        self._to_go = 0
+        self._eof = False
+
+    def drain(self):
+        while self.read(1 << 16): pass
+
+    def read(self, n = -1):
+        parts, have = [], 0
+        while not self._eof and (n is None or n < 0 or have < n):
+            if 0 == self._to_go:
+                self._to_go = int(self._f.readline())
+                if 0 == self._to_go:
+                    self._eof = True
+                    break
+            want = self._to_go
+            if n is not None and n >= 0: want = min(want, n - have)
+            buf = self._f.read(want)
+            if len(buf) != want:
+                raise IOError(errno.EPIPE, 'Short read from pipe')
+            parts.append(buf)
+            have += len(buf)
+            self._to_go -= len(buf)
+        return ''.join(parts)
+
+def _send_framed(fin, fout):
+    for buf in iter(lambda: fin.read(1 << 16), ''):
+        fout.write('%d\n' % len(buf))
+        fout.write(buf)
+    fout.write('0\n')
+
+def serve(hd, fin = None, fout = None):
+    '''
+    Answer the requests of a HashDirPipe for the HashDir hd.  Requests are
+    read from fin (stdin by default) and answered on fout (stdout by
+    default) until a quit request or the end of fin.
+    '''
+    if fin is None: fin = sys.stdin
+    if fout is None: fout = sys.stdout
+    while True:
+        ln = fin.readline()
+        if not ln: break
+        F = ln.split()
+        lines = []
+        try:
+            if 'quit' == F[0]:
+                break
+            elif 'algo' == F[0]:
+                lines = [hd.algo]
+            elif 'summaries' == F[0]:
+                lines = ['%s %s' % kv for kv in
+                    sorted(hd.bucket_summaries().iteritems())]
+            elif 'digests' == F[0]:
+                lines = hd.bucket_digests(F[1])
+            elif 'size' == F[0]:
+                size = hd.size_of(F[1])
+                lines = ['-' if size is None else str(size)]
+            elif 'get' == F[0]:
+                try:
+                    f = hd.openFileFromHexDigest(F[1])
+                except IOError, e:
+                    if errno.ENOENT != e.errno: raise
+                    lines = ['-']
+                else:
+                    with f:
+                        fout.write('+\n')
+                        _send_framed(f, fout)
+                    fout.flush()
+                    continue
+            elif 'put' == F[0]:
+                src = _FramedReader(fin)
+                try:
+                    lines = [hd.addFile(src)]
+                finally:
+                    # Whatever wasn't added still has to be read past to
+                    # get to the next request.
+                    src.drain()
+            else:
+                raise ValueError('Unknown request: ' + F[0])
+        except Exception, e:
+            lines = ['!' + str(e).replace('\n', ' ')]
+        fout.write(''.join([x + '\n' for x in lines]) + '\n')
+        fout.flush()
+
+class HashDirPipe(object):
+    '''
+    This talks to a HashDir served by serve() in a subprocess started with
+    the argument list args and acts enough like a HashDir for sync().
+    Requests are sent one at a time so transfers over one pipe aren't
+    concurrent.
+    '''
+    def __init__(self, args, env = None):
+        self._proc = subprocess.Popen(args, stdin = subprocess.PIPE,
+            stdout = subprocess.PIPE, env = env)
+        self._lock = threading.Lock()
+        self.algo = self._request('algo')[0]
+
+    @classmethod
+    def spawn(cls, rootdir):
+        '''Serve rootdir from "python -m pu.hashdir serve rootdir".'''
+        env = dict(os.environ)
+        here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env['PYTHONPATH'] = os.pathsep.join(
+            [here] + filter(None, [env.get('PYTHONPATH')]))
+        return cls([sys.executable, '-m', 'pu.hashdir', 'serve', rootdir],
+            env)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._proc is None: return
+        with self._lock:
+            try:
+                self._proc.stdin.write('quit\n')
+                self._proc.stdin.close()
+            finally:
+                self._proc.wait()
+                self._proc = None
+
+    def _send(self, req):
+        self._proc.stdin.write(req + '\n')
+        self._proc.stdin.flush()
+
+    def _answer(self):
+        lines = []
+        while True:
+            ln = self._proc.stdout.readline()
+            if not ln: raise IOError(errno.EPIPE, 'HashDir server went away')
+            ln = ln.rstrip('\n')
+            if not ln: break
+            lines.append(ln)
+        if lines and lines[0].startswith('!'): raise IOError(lines[0][1:])
+        return lines
+
+    def _request(self, req):
+        with self._lock:
+            self._send(req)
+            return self._answer()
+
+    def bucket_summaries(self):
+        return dict([ln.split() for ln in self._request('summaries')])
+
+    def bucket_digests(self, prefix):
+        return self._request('digests ' + prefix)
+
+    def size_of(self, digest):
+        size = self._request('size ' + digest)[0]
+        return None if '-' == size else int(size)
 
     def openFileFromHexDigest(self, digest):
-        '''Open the file associated with the given digest for reading.'''
-        return open(self.pathFromHexDigest(digest), 'rb')
+        '''
+        Return a file-like object for the content of digest.  The pipe is
+        tied up until it's closed.
+        '''
+        self._lock.acquire()
+        try:
+            self._send('get ' + digest)
+            status = self._proc.stdout.readline()
+            if '+\n' != status:
+                self._proc.stdout.readline()
+                if status.startswith('!'): raise IOError(status[1:].strip())
+                raise IOError(errno.ENOENT, 'No such object', digest)
+            return _ServedObject(_FramedReader(self._proc.stdout),
+                self._lock.release)
+        except:
+            self._lock.release()
+            raise
+
+    def addFile(self, addee):
+        f = open(addee, 'rb') if isinstance(addee, basestring) else addee
+        try:
+            with self._lock:
+                self._send('put')
+                _send_framed(f, self._proc.stdin)
+                self._proc.stdin.flush()
+                return self._answer()[0]
+        finally:
+            if id(f) != id(addee): f.close()
+
+class _ServedObject(object):
+    # What a HashDirPipe hands out for an object; the rest of it is read
+    # and discarded on close so that the pipe is ready for what's next.
+    def __init__(self, reader, done):
+        self._reader = reader
+        self._done = done
+        self.name = '<pipe>'
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def read(self, n = -1):
+        return self._reader.read(n)
+
+    def close(self):
+        if self.closed: return
+        self.closed = True
+        try:
+            while self._reader.read(1 << 16): pass
+        finally:
+            self._done()
+
+def _sync_job(job):
+    src, dst, digest = job
+    try:
+        with src.openFileFromHexDigest(digest) as f:
+            got = dst.addFile(f)
+        if got != digest:
+            raise IOError(errno.EIO, 'Content of %s hashed to %s' % (
+                digest, got))
+        return digest, None
+    except Exception, e:
+        return digest, e
+
+def sync(src, dst, workers = None):
+    '''
+    Copy the objects that src has and dst lacks into dst.  src and dst can
+    be HashDirs or HashDirPipes.  Bucket summaries are compared first so
+    that only the digests of buckets that differ are exchanged.  Objects
+    are copied across a pool of workers through dst's add path and their
+    digests checked.  Return a tuple (copied, failures) where copied is a
+    list of the digests copied and failures is a list of (digest,
+    exception) tuples.
+    '''
+    if src.algo != dst.algo:
+        raise ValueError('Algorithms differ: %s, %s' % (src.algo, dst.algo))
+    if workers is None: workers = multiprocessing.cpu_count()
+
+    src_sums, dst_sums = src.bucket_summaries(), dst.bucket_summaries()
+    missing = []
+    for prefix in sorted(src_sums):
+        if src_sums[prefix] == dst_sums.get(prefix): continue
+        have = set(dst.bucket_digests(prefix) if prefix in dst_sums else [])
+        missing.extend([d for d in src.bucket_digests(prefix)
+            if d not in have])
+
+    jobs = [(src, dst, d) for d in missing]
+    if workers <= 1 or len(jobs) <= 1:
+        results = map(_sync_job, jobs)
+    else:
+        pool = multiprocessing.pool.ThreadPool(min(workers, len(jobs)))
+        try:
+            results = pool.map(_sync_job, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+    copied, failures = [], []
+    for digest, error in results:
+        if error is None:
+            copied.append(digest)
+        else:
+            failures.append((digest, error))
+
+    return copied, failures
+
+if '__main__' == __name__:
+    if 3 != len(sys.argv) or 'serve' != sys.argv[1]:
+        sys.exit('usage: %s serve <rootdir>' % sys.argv[0])
+    _check_rootdir(sys.argv[2])
+    with HashDir(sys.argv[2]) as hd:
+        serve(hd)
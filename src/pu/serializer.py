@@ -1,13 +1,539 @@
 #
 # Copyright (c) 2012-2013 Joshua Hughes <kivhift@gmail.com>
 #
-import re
+import array
+import errno
+import mmap
+import os
+import struct
+import sys
+import weakref
 
 from pu.utils import is_a_string, is_an_integer, DataContainer
 
 class SelfSerializerError(Exception): pass
 class SelfSerializerEmptyHeaderError(Exception): pass
 
+# Values are encoded by appending strings to a list that's written out in
+# one go.  The encoder for a value is looked up by its exact type; values of
+# subclasses fall back to _serializable_type(), which mirrors the
+# isinstance() checks that decide what's serializable.
+def _encode(out, name, val):
+    enc = _encoders.get(type(val))
+    if enc is None: enc = _encoders[_serializable_type(val, name)]
+    enc(out, name, val)
+
+def _encode_int(out, name, val):
+    out.append('^i %s %d\n' % (name, val))
+
+def _encode_str(out, name, val):
+    out.append('^b %s %d\n' % (name, len(val)))
+    out.append(val)
+
+def _encode_list(out, name, val):
+    out.append('^a %s %d\n' % (name, len(val)))
+    append, get = out.append, _encoders.get
+    for i, e in enumerate(val):
+        enc = get(type(e))
+        # Arrays of ints are common enough to be encoded inline.
+        if enc is _encode_int:
+            append('^i %d %d\n' % (i, e))
+            continue
+        if enc is None: enc = _encoders[_serializable_type(e, str(i))]
+        enc(out, str(i), e)
+
+def _encode_dict(out, name, val):
+    out.append('^h %s %d\n' % (name, len(val)))
+    for i, k in enumerate(sorted(val)):
+        ks = str(i)
+        _encode(out, ks, k)
+        _encode(out, ks, val[k])
+
+# Lazily loaded records hand out buffers for their strings.
+def _encode_buffer(out, name, val):
+    _encode_str(out, name, str(val))
+
+def _encode_float(out, name, val):
+    hexflt = val.hex()
+    out.append('^f %s %d\n' % (name, len(hexflt)))
+    out.append(hexflt)
+
+# Arrays are written as one block of their typecode, their itemsize as a
+# digit and their items as little-endian machine values.  Since the size of
+# some typecodes ('l', 'L', 'i', 'I' and 'u') depends on the platform, items
+# of a size other than the local one are converted where they fit.
+def _array_bytes(val):
+    if 'big' == sys.byteorder:
+        val = array.array(val.typecode, val)
+        val.byteswap()
+    return '%s%d' % (val.typecode, val.itemsize) + val.tostring()
+
+_int_codes = {1 : 'b', 2 : 'h', 4 : 'i', 8 : 'q'}
+
+def _array_from_bytes(data):
+    try:
+        code, size = data[0], int(data[1])
+        val = array.array(code)
+    except (IndexError, ValueError):
+        raise SelfSerializerError('Bad array type.')
+    items = data[2:]
+    if not size or len(items) % size:
+        raise SelfSerializerError('Array length is off: %d' % len(data))
+    if size != val.itemsize: return _convert_array(code, size, items)
+    val.fromstring(items)
+    if 'big' == sys.byteorder: val.byteswap()
+    return val
+
+def _convert_array(code, size, items):
+    # Load items written where code's items are size bytes.
+    if 'u' == code and size in (2, 4):
+        return array.array(code,
+            items.decode('utf-16-le' if 2 == size else 'utf-32-le'))
+    if code not in 'bBhHiIlL' or size not in _int_codes:
+        raise SelfSerializerError(
+            'Bad itemsize for %r: %d' % (code, size))
+    fmt = _int_codes[size]
+    if code.isupper(): fmt = fmt.upper()
+    try:
+        return array.array(code,
+            struct.unpack('<%d%s' % (len(items) // size, fmt), items))
+    except OverflowError:
+        raise SelfSerializerError(
+            "Array items don't fit %r here: %d" % (code, size))
+
+def _encode_array(out, name, val):
+    data = _array_bytes(val)
+    out.append('^n %s %d\n' % (name, len(data)))
+    out.append(data)
+
+_encoders = {int : _encode_int, long : _encode_int, bool : _encode_int,
+    str : _encode_str, list : _encode_list, dict : _encode_dict,
+    float : _encode_float, buffer : _encode_buffer,
+    array.array : _encode_array}
+
+def _serializable_type(val, name = None):
+    if is_an_integer(val): return int
+    for type_ in (str, list, dict, float, array.array):
+        if isinstance(val, type_): return type_
+    if name is None: raise ValueError("Can't serialize %s." % type(val))
+    raise ValueError("Can't serialize %s, %s." % (name, type(val)))
+
+# Values are decoded from a header line of "^<tag> <name> <intval>"
+# followed by whatever the tag's decoder reads.
+def _decode(readline, read):
+    H = readline().split()
+    try:
+        tag, name, intval = H
+        dec = _decoders[tag]
+        intval = int(intval)
+    except (ValueError, KeyError):
+        raise SelfSerializerError('Had trouble determining type.')
+    return name, dec(readline, read, intval)
+
+def _decode_list(readline, read, n):
+    tmp = []
+    append = tmp.append
+    for i in xrange(n):
+        H = readline().split()
+        # Arrays of ints are common enough to be decoded inline.
+        if 3 == len(H) and '^i' == H[0] and H[1] == str(i):
+            try:
+                append(int(H[2]))
+                continue
+            except ValueError:
+                raise SelfSerializerError('Had trouble determining type.')
+        try:
+            tag, name, intval = H
+            dec = _decoders[tag]
+            intval = int(intval)
+        except (ValueError, KeyError):
+            raise SelfSerializerError('Had trouble determining type.')
+        if name != str(i):
+            raise SelfSerializerError('Array element out of order.')
+        append(dec(readline, read, intval))
+    return tmp
+
+def _decode_dict(readline, read, n):
+    tmp = {}
+    for i in xrange(n):
+        si = str(i)
+        name, k = _decode(readline, read)
+        if name != si:
+            raise SelfSerializerError('dict key out of order.')
+        name, v = _decode(readline, read)
+        if name != si:
+            raise SelfSerializerError('dict value out of order.')
+        tmp[k] = v
+    return tmp
+
+def _decode_bytes(readline, read, n):
+    val = read(n)
+    if len(val) != n: raise SelfSerializerError('Truncated record.')
+    return val
+
+_decoders = {
+    '^i' : lambda readline, read, n: n,
+    '^b' : _decode_bytes,
+    '^a' : _decode_list,
+    '^h' : _decode_dict,
+    '^f' : lambda readline, read, n: float.fromhex(
+        _decode_bytes(readline, read, n)),
+    '^n' : lambda readline, read, n: _array_from_bytes(
+        _decode_bytes(readline, read, n)),
+}
+
+# The binary format follows a header line of "\x1eSB <class> <items>
+# <length>" with a body of length bytes that's read in one go.  The body is
+# a varint-prefixed name and a value for each item.  A value is a one-byte
+# tag followed by:
+#
+#   i   a little-endian int64
+#   I   a varint byte count and that many bytes of a little-endian two's
+#       complement integer that doesn't fit in an int64
+#   f   a little-endian IEEE double
+#   b   a varint length and that many bytes
+#   a   a varint count and that many values
+#   A   a struct type code, a varint count and that many packed values
+#       (arrays of just ints or just floats)
+#   h   a varint count and that many key-value pairs of values in key order
+#   n   a varint length and that many bytes of an array.array as written
+#       in the text format
+#
+# Varints are unsigned and little-endian base 128.
+_int64 = struct.Struct('<q')
+_double = struct.Struct('<d')
+_packed_int_codes = (('b', 1 << 7), ('h', 1 << 15), ('i', 1 << 31),
+    ('q', 1 << 63))
+
+def _varint(n):
+    if n < 0x80: return chr(n)
+    parts = []
+    while n >= 0x80:
+        parts.append(chr(n & 0x7f | 0x80))
+        n >>= 7
+    parts.append(chr(n))
+    return ''.join(parts)
+
+def _bin_encode(out, val):
+    enc = _bin_encoders.get(type(val))
+    if enc is None: enc = _bin_encoders[_serializable_type(val)]
+    enc(out, val)
+
+def _bin_encode_int(out, val):
+    if -(1 << 63) <= val < (1 << 63):
+        out.append('i' + _int64.pack(val))
+        return
+    n = (val.bit_length() + 8) // 8
+    twos = '%0*x' % (2 * n, val & ((1 << (8 * n)) - 1))
+    out.append('I' + _varint(n) + twos.decode('hex')[::-1])
+
+def _bin_encode_str(out, val):
+    out.append('b' + _varint(len(val)))
+    out.append(val)
+
+def _bin_encode_buffer(out, val):
+    _bin_encode_str(out, str(val))
+
+def _bin_encode_float(out, val):
+    out.append('f' + _double.pack(val))
+
+def _bin_encode_array(out, val):
+    data = _array_bytes(val)
+    out.append('n' + _varint(len(data)))
+    out.append(data)
+
+def _packed_code(val):
+    # Return the struct code that all of val can be packed with or None.
+    types = set(map(type, val))
+    if types == set([float]): return 'd'
+    if not types or not types <= set([int, long, bool]): return None
+    lo, hi = min(val), max(val)
+    for code, limit in _packed_int_codes:
+        if -limit <= lo and hi < limit: return code
+    return None
+
+def _bin_encode_list(out, val):
+    code = _packed_code(val)
+    if code is not None:
+        out.append('A' + code + _varint(len(val)))
+        out.append(struct.pack('<%d%s' % (len(val), code), *val))
+        return
+    out.append('a' + _varint(len(val)))
+    for e in val: _bin_encode(out, e)
+
+def _bin_encode_dict(out, val):
+    out.append('h' + _varint(len(val)))
+    for k in sorted(val):
+        _bin_encode(out, k)
+        _bin_encode(out, val[k])
+
+_bin_encoders = {int : _bin_encode_int, long : _bin_encode_int,
+    bool : _bin_encode_int, str : _bin_encode_str, list : _bin_encode_list,
+    dict : _bin_encode_dict, float : _bin_encode_float,
+    buffer : _bin_encode_buffer, array.array : _bin_encode_array}
+
+# Binary decoders take the body and the position of what they decode and
+# return the value along with the position after it.
+def _read_varint(data, pos):
+    b = ord(data[pos])
+    if b < 0x80: return b, pos + 1
+    n, shift = 0, 0
+    while b >= 0x80:
+        n |= (b & 0x7f) << shift
+        shift += 7
+        pos += 1
+        b = ord(data[pos])
+    return n | (b << shift), pos + 1
+
+def _read_bytes(data, pos):
+    n, pos = _read_varint(data, pos)
+    end = pos + n
+    if end > len(data): raise IndexError('Truncated bytes.')
+    return data[pos : end], end
+
+def _bin_decode(data, pos):
+    try:
+        dec = _bin_decoders[data[pos]]
+    except KeyError:
+        raise SelfSerializerError('Had trouble determining type.')
+    return dec(data, pos + 1)
+
+def _bin_decode_big_int(data, pos):
+    b, pos = _read_bytes(data, pos)
+    val = int(b[::-1].encode('hex'), 16)
+    if val >= 1 << (8 * len(b) - 1): val -= 1 << (8 * len(b))
+    return val, pos
+
+def _bin_decode_list(data, pos):
+    n, pos = _read_varint(data, pos)
+    tmp = []
+    for i in xrange(n):
+        v, pos = _bin_decode(data, pos)
+        tmp.append(v)
+    return tmp, pos
+
+def _bin_decode_packed(data, pos):
+    code = data[pos]
+    if code not in 'bhiqd':
+        raise SelfSerializerError('Bad array type: %r' % code)
+    n, pos = _read_varint(data, pos + 1)
+    fmt = '<%d%s' % (n, code)
+    return list(struct.unpack_from(fmt, data, pos)), \
+        pos + struct.calcsize(fmt)
+
+def _bin_decode_dict(data, pos):
+    n, pos = _read_varint(data, pos)
+    tmp = {}
+    for i in xrange(n):
+        k, pos = _bin_decode(data, pos)
+        v, pos = _bin_decode(data, pos)
+        tmp[k] = v
+    return tmp, pos
+
+def _bin_decode_array(data, pos):
+    b, pos = _read_bytes(data, pos)
+    return _array_from_bytes(b), pos
+
+_bin_decoders = {
+    'i' : lambda data, pos: (_int64.unpack_from(data, pos)[0], pos + 8),
+    'I' : _bin_decode_big_int,
+    'f' : lambda data, pos: (_double.unpack_from(data, pos)[0], pos + 8),
+    'b' : _read_bytes,
+    'a' : _bin_decode_list,
+    'A' : _bin_decode_packed,
+    'h' : _bin_decode_dict,
+    'n' : _bin_decode_array,
+}
+
+def _bin_skip(data, pos):
+    # Return the position after the value at pos without decoding it.
+    tag = data[pos]
+    pos += 1
+    if tag in 'if': return pos + 8
+    if tag in 'Ibn':
+        n, pos = _read_varint(data, pos)
+        return pos + n
+    if tag in 'ah':
+        n, pos = _read_varint(data, pos)
+        for i in xrange(n if 'a' == tag else 2 * n):
+            pos = _bin_skip(data, pos)
+        return pos
+    if 'A' == tag:
+        code = data[pos]
+        if code not in 'bhiqd':
+            raise SelfSerializerError('Bad array type: %r' % code)
+        n, pos = _read_varint(data, pos + 1)
+        return pos + n * struct.calcsize('<' + code)
+    raise SelfSerializerError('Had trouble determining type.')
+
+def _read_header(f):
+    ln = f.readline()
+    if not ln: raise SelfSerializerEmptyHeaderError('Empty header.')
+    H = ln.split()
+    binary = bool(H) and SelfSerializer._binary_record_sep == H[0]
+    if binary:
+        if 4 != len(H):
+            raise SelfSerializerError('Incorrect record separator.')
+    elif (len(H) != 3) or (H[0] != SelfSerializer._record_sep):
+        raise SelfSerializerError('Incorrect record separator.')
+    count = int(H[2])
+    if count < 0:
+        raise SelfSerializerError('Invalid length: %d' % count)
+    return binary, H[1], count, int(H[3]) if binary else None
+
+# Records are skipped without decoding them.  Binary records say how long
+# they are.  Text records have to be walked since a ^b payload can hold
+# anything, record separators included, but payloads are seeked past.
+def _skip_record(f, binary, count, length):
+    if binary:
+        f.seek(length, os.SEEK_CUR)
+        return
+    for i in xrange(count):
+        _skip_text(f)
+
+def _skip_text(f):
+    H = f.readline().split()
+    try:
+        tag, name, n = H
+        n = int(n)
+    except ValueError:
+        raise SelfSerializerError('Had trouble determining type.')
+    if tag in ('^b', '^f', '^n'):
+        f.seek(n, os.SEEK_CUR)
+    elif '^a' == tag:
+        # Arrays of ints are common enough to be skipped inline.
+        readline, tell, seek = f.readline, f.tell, f.seek
+        for i in xrange(n):
+            pos = tell()
+            if not readline().startswith('^i '):
+                seek(pos)
+                _skip_text(f)
+    elif '^h' == tag:
+        for i in xrange(2 * n): _skip_text(f)
+    elif '^i' != tag:
+        raise SelfSerializerError('Had trouble determining type.')
+
+class _LazyItems(object):
+    '''
+    The items of a lazily loaded record that haven't been decoded yet: where
+    each starts in the mmap of the record's file.
+    '''
+    def __init__(self, mm, binary):
+        self.mm = mm
+        self.binary = binary
+        self.spans = {}
+
+    def decode(self, name):
+        pos = self.spans.pop(name)
+        if self.binary: return _bin_decode(self.mm, pos)[0]
+        self.mm.seek(pos)
+        return _decode(self.mm.readline, self.mm.read)[1]
+
+# Lazily loaded instances by id() along with a weak reference that drops
+# them from here when they go away.  Keeping this out of the instances
+# keeps their __dict__ down to just what's been loaded.
+_lazy_items = {}
+
+def _forget_lazy(key):
+    return lambda ref: _lazy_items.pop(key, None)
+
+class _RecordIndex(object):
+    '''
+    Sidecar index of where the records of a serialized file start.  It's a
+    header of magic and how many bytes of the file are covered followed by
+    a little-endian uint64 offset per record so that finding record N is a
+    seek.  An index that covers more than the file has or that doesn't
+    line up with a record is thrown away and rebuilt.
+    '''
+    _suffix = '.ssidx'
+    _magic = 'SSIX'
+    _header = struct.Struct('<4sQ')
+    _entry = struct.Struct('<Q')
+
+    def __init__(self, path):
+        self.path = path + _RecordIndex._suffix
+        self.f = None
+        self.covered = self.count = 0
+        self.pending = []
+
+    def open(self, create = True):
+        try:
+            self.f = open(self.path, 'r+b')
+        except IOError, e:
+            if errno.ENOENT != e.errno or not create: raise
+            self.f = open(self.path, 'w+b')
+        hdr = self.f.read(self._header.size)
+        size = os.fstat(self.f.fileno()).st_size
+        if len(hdr) != self._header.size or (
+                self._magic != self._header.unpack(hdr)[0]):
+            self.reset()
+            return
+        self.covered = self._header.unpack(hdr)[1]
+        self.count = (size - self._header.size) // self._entry.size
+
+    def reset(self):
+        self.f.seek(0)
+        self.f.truncate()
+        self.f.write(self._header.pack(self._magic, 0))
+        self.covered = self.count = 0
+        del self.pending[:]
+
+    def append(self, offset, end):
+        self.pending.append(offset)
+        self.covered = end
+        self.count += 1
+        if len(self.pending) >= 4096: self.flush()
+
+    def flush(self):
+        if not self.pending: return
+        done = self.count - len(self.pending)
+        self.f.seek(self._header.size + done * self._entry.size)
+        self.f.write(struct.pack('<%dQ' % len(self.pending), *self.pending))
+        self.f.seek(0)
+        self.f.write(self._header.pack(self._magic, self.covered))
+        del self.pending[:]
+
+    def offset(self, n):
+        if not 0 <= n < self.count: raise IndexError(n)
+        self.flush()
+        self.f.seek(self._header.size + n * self._entry.size)
+        return self._entry.unpack(self.f.read(self._entry.size))[0]
+
+    def check(self, f):
+        '''
+        Throw away the index if it doesn't fit f, the file it indexes.
+        '''
+        size = os.fstat(f.fileno()).st_size
+        if self.covered > size:
+            self.reset()
+        elif self.covered < size:
+            f.seek(self.covered)
+            if f.read(4) not in (SelfSerializer._record_sep + ' ',
+                    SelfSerializer._binary_record_sep + ' '):
+                self.reset()
+        return size
+
+    def catch_up(self, f):
+        '''
+        Index whatever records of f are past what's covered.
+        '''
+        size = self.check(f)
+        f.seek(self.covered)
+        while self.covered < size:
+            offset = self.covered
+            binary, class_name, count, length = _read_header(f)
+            _skip_record(f, binary, count, length)
+            end = f.tell()
+            if end > size: raise SelfSerializerError('Truncated record.')
+            self.append(offset, end)
+        self.flush()
+
+    def close(self):
+        if self.f is None: return
+        self.flush()
+        self.f.close()
+        self.f = None
+
 class SelfSerializer(object):
     '''
     SelfSerializer can serialize itself given that every item in its __dict__
@@ -20,59 +546,323 @@ class SelfSerializer(object):
     '''
 
     _record_sep = '\x1eSS'
-    _serializable_types = (int, long, str, list, dict, float)
+    _binary_record_sep = '\x1eSB'
+    _serializable_types = (int, long, str, list, dict, float, buffer,
+        array.array)
+    _io_buffer_size = 1 << 20
 
     def __init__(self):
         super(SelfSerializer, self).__init__()
 
-    def dump(self, fout, append = True):
+    def dump(self, fout, append = True, binary = False):
         '''
         Dump the calling instance to fout.  fout can either be a file to open
         or a file-like object to be written to.  A to-be-opened file is
         appended to by default.  Make append false to truncate a
-        possibly-extant file.
+        possibly-extant file.  If binary is True, then the instance is
+        dumped in a more compact binary format that's quicker to load;
+        load() tells the two apart by themselves.
         '''
+        self.materialize()
         if not self._is_serializable():
             raise SelfSerializerError('Cannot serialize.')
 
-        d = self.__dict__
-        keys = d.keys()
+        keys = self.__dict__.keys()
         keys.sort()
 
-        f = open(fout, 'ab' if append else 'wb') if is_a_string(fout) else fout
-        f.write('%s %s %d\n' % (
-            SelfSerializer._record_sep, self.__class__.__name__, len(keys)))
+        if not is_a_string(fout):
+            self._dump(fout, keys, binary)
+            return
+        with open(fout, 'ab' if append else 'wb',
+                SelfSerializer._io_buffer_size) as f:
+            f.seek(0, os.SEEK_END)
+            offset = f.tell()
+            self._dump(f, keys, binary)
+            end = f.tell()
+        self._note_dumped(fout, offset, end)
+
+    def _dump(self, f, keys, binary):
+        d = self.__dict__
+        if binary:
+            out = []
+            for k in keys:
+                out.append(_varint(len(k)) + k)
+                _bin_encode(out, d[k])
+            body = ''.join(out)
+            f.write('%s %s %d %d\n' % (SelfSerializer._binary_record_sep,
+                self.__class__.__name__, len(keys), len(body)))
+            f.write(body)
+            return
+
+        out = ['%s %s %d\n' % (
+            SelfSerializer._record_sep, self.__class__.__name__, len(keys))]
         for k in keys:
-            self._serialize(f, k, d[k])
-        if is_a_string(fout): f.close()
+            _encode(out, k, d[k])
+            # Keep what's held in memory bounded for big instances.
+            if len(out) > 4096:
+                f.write(''.join(out))
+                del out[:]
+        f.write(''.join(out))
+
+    @staticmethod
+    def _note_dumped(path, offset, end):
+        # Only an index that's already there and up to date is kept up.
+        idx = _RecordIndex(path)
+        try:
+            idx.open(create = False)
+        except (IOError, OSError):
+            return
+        try:
+            if 0 == offset: idx.reset()
+            if idx.covered == offset: idx.append(offset, end)
+        finally:
+            idx.close()
 
-    def load(self, fin):
+    def load(self, fin, lazy = False):
         '''
         Load the calling instance from fin.  fin can either be a file to open
-        or a file-like object to be read from.
+        or a file-like object to be read from.  If lazy is True, then fin
+        has to be a file or a real file object since it's mmapped.  Just
+        the record's headers are read up front; lists and dicts are decoded
+        when first gotten at and then kept, and strings come back as
+        buffers into the mmap.  Until everything has been gotten at or
+        materialize() is called, __dict__ only has what has been.
         '''
+        if lazy:
+            self._load_lazy(fin)
+            return
+        f = open(fin, 'rb', SelfSerializer._io_buffer_size) \
+            if is_a_string(fin) else fin
+        binary, class_name, indicated_len, length = _read_header(f)
+        if self.__class__.__name__ != class_name:
+            raise SelfSerializerError('Incorrect name: %s' % class_name)
+        tmp_dict = self._load_body(f, binary, indicated_len, length)
+        if is_a_string(fin): f.close()
+
+        _lazy_items.pop(id(self), None)
+        self.__dict__ = tmp_dict
+
+    def _load_lazy(self, fin):
         f = open(fin, 'rb') if is_a_string(fin) else fin
-        ln = f.readline()
-        if not ln: raise SelfSerializerEmptyHeaderError('Empty header.')
-        H = ln.split()
-        if (len(H) != 3) or (H[0] != SelfSerializer._record_sep):
-            raise SelfSerializerError('Incorrect record separator.')
-        class_name, indicated_len = H[1], int(H[2])
+        try:
+            start = f.tell()
+            if start >= os.fstat(f.fileno()).st_size:
+                raise SelfSerializerEmptyHeaderError('Empty header.')
+            mm = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        finally:
+            if is_a_string(fin): f.close()
+        mm.seek(start)
+        binary, class_name, count, length = _read_header(mm)
         if self.__class__.__name__ != class_name:
             raise SelfSerializerError('Incorrect name: %s' % class_name)
-        if indicated_len < 0:
-            raise SelfSerializerError('Invalid length: %d' % indicated_len)
-        tmp_dict = dict()
-        for i in xrange(indicated_len):
-            name, val = self._deserialize(f)
-            tmp_dict[name] = val
-        if len(tmp_dict) != indicated_len:
+        items, tmp_dict = _LazyItems(mm, binary), dict()
+        scan = self._scan_binary if binary else self._scan_text
+        try:
+            end = scan(mm, count, length, tmp_dict, items.spans)
+        except (IndexError, ValueError, struct.error):
+            raise SelfSerializerError('Truncated record.')
+        if len(tmp_dict) + len(items.spans) != count:
             raise SelfSerializerError(
                 'Incorrect number of items: %d != %d' % (
-                    len(tmp_dict), indicated_len))
-        if is_a_string(fin): f.close()
+                    len(tmp_dict) + len(items.spans), count))
+        if not is_a_string(fin): f.seek(end)
 
+        _lazy_items.pop(id(self), None)
         self.__dict__ = tmp_dict
+        if items.spans:
+            key = id(self)
+            _lazy_items[key] = (weakref.ref(self, _forget_lazy(key)), items)
+
+    def _scan_text(self, mm, count, length, tmp_dict, spans):
+        readline, read = mm.readline, mm.read
+        for i in xrange(count):
+            pos = mm.tell()
+            H = readline().split()
+            try:
+                tag, name, n = H
+                dec = _decoders[tag]
+                n = int(n)
+            except (ValueError, KeyError):
+                raise SelfSerializerError('Had trouble determining type.')
+            if tag in ('^a', '^h', '^n'):
+                spans[name] = pos
+                mm.seek(pos)
+                _skip_text(mm)
+            elif '^b' == tag:
+                start = mm.tell()
+                mm.seek(n, os.SEEK_CUR)
+                tmp_dict[name] = buffer(mm, start, n)
+            else:
+                tmp_dict[name] = dec(readline, read, n)
+        return mm.tell()
+
+    def _scan_binary(self, mm, count, length, tmp_dict, spans):
+        pos = mm.tell()
+        end = pos + length
+        if end > len(mm): raise SelfSerializerError('Truncated record.')
+        for i in xrange(count):
+            name, pos = _read_bytes(mm, pos)
+            tag = mm[pos]
+            if 'b' == tag:
+                n, start = _read_varint(mm, pos + 1)
+                pos = start + n
+                tmp_dict[name] = buffer(mm, start, n)
+            elif tag in 'aAhn':
+                spans[name] = pos
+                pos = _bin_skip(mm, pos)
+            else:
+                tmp_dict[name], pos = _bin_decode(mm, pos)
+        if pos != end:
+            raise SelfSerializerError('Record has trailing bytes.')
+        return end
+
+    def __getattr__(self, name):
+        lazy = _lazy_items.get(id(self))
+        if lazy is None or name not in lazy[1].spans:
+            raise AttributeError("'%s' object has no attribute '%s'" % (
+                self.__class__.__name__, name))
+        items = lazy[1]
+        val = self.__dict__[name] = items.decode(name)
+        if not items.spans: del _lazy_items[id(self)]
+        return val
+
+    def _pending(self):
+        # Return the names of the items a lazy load left for later.
+        lazy = _lazy_items.get(id(self))
+        if lazy is None: return []
+        return [k for k in lazy[1].spans if k not in self.__dict__]
+
+    def materialize(self):
+        '''
+        Decode whatever a lazy load left for later so that __dict__ has
+        everything.  Nothing is done after a load that wasn't lazy.
+        '''
+        lazy = _lazy_items.pop(id(self), None)
+        if lazy is None: return
+        items = lazy[1]
+        for name in items.spans.keys():
+            val = items.decode(name)
+            self.__dict__.setdefault(name, val)
+
+    def _load_body(self, f, binary, count, length):
+        if binary:
+            tmp_dict = self._load_binary(f, count, length)
+        else:
+            tmp_dict = dict()
+            readline, read = f.readline, f.read
+            for i in xrange(count):
+                name, val = _decode(readline, read)
+                tmp_dict[name] = val
+        if len(tmp_dict) != count:
+            raise SelfSerializerError(
+                'Incorrect number of items: %d != %d' % (
+                    len(tmp_dict), count))
+        return tmp_dict
+
+    @classmethod
+    def _record_classes(cls):
+        found, todo = {}, [cls]
+        while todo:
+            k = todo.pop(0)
+            found.setdefault(k.__name__, k)
+            todo.extend(k.__subclasses__())
+        return found
+
+    @classmethod
+    def _load_record(cls, f, classes):
+        binary, class_name, count, length = _read_header(f)
+        klass = classes.get(class_name)
+        if klass is None:
+            _skip_record(f, binary, count, length)
+            return class_name, None
+        # Skip __init__() since load() replaces whatever it would set up.
+        inst = klass.__new__(klass)
+        inst.__dict__ = inst._load_body(f, binary, count, length)
+        return class_name, inst
+
+    @classmethod
+    def iter_records(cls, path):
+        '''
+        Generate (class name, offset, instance) for each record in the file
+        at path, holding just one record at a time.  Records are loaded as
+        instances of cls or of its subclasses by class name; records of
+        other classes are skipped over and come with an instance of None.
+        A sidecar index of where the records start (path + '.ssidx') is
+        built along the way if it isn't there already.  dump() keeps an
+        existing index up to date.
+        '''
+        classes = cls._record_classes()
+        idx = _RecordIndex(path)
+        with open(path, 'rb', SelfSerializer._io_buffer_size) as f:
+            try:
+                idx.open()
+                idx.check(f)
+                f.seek(0)
+            except (IOError, OSError):
+                idx.close()
+                idx = None
+            try:
+                while True:
+                    offset = f.tell()
+                    try:
+                        class_name, inst = cls._load_record(f, classes)
+                    except SelfSerializerEmptyHeaderError:
+                        break
+                    if idx is not None and offset == idx.covered:
+                        idx.append(offset, f.tell())
+                    yield class_name, offset, inst
+            finally:
+                if idx is not None: idx.close()
+
+    @classmethod
+    def count_records(cls, path):
+        '''
+        Return how many records the file at path holds using its sidecar
+        index, which is built or caught up as need be.
+        '''
+        idx = _RecordIndex(path)
+        with open(path, 'rb', SelfSerializer._io_buffer_size) as f:
+            try:
+                idx.open()
+                idx.catch_up(f)
+                return idx.count
+            finally:
+                idx.close()
+
+    @classmethod
+    def load_record(cls, path, n):
+        '''
+        Return (class name, offset, instance) for record n of the file at
+        path with the record found by way of the sidecar index.  Records are
+        loaded as with iter_records().  IndexError is raised if there's no
+        record n.
+        '''
+        idx = _RecordIndex(path)
+        with open(path, 'rb', SelfSerializer._io_buffer_size) as f:
+            try:
+                idx.open()
+                idx.catch_up(f)
+                offset = idx.offset(n)
+            finally:
+                idx.close()
+            f.seek(offset)
+            class_name, inst = cls._load_record(f, cls._record_classes())
+        return class_name, offset, inst
+
+    def _load_binary(self, f, count, length):
+        body = f.read(length)
+        if len(body) != length:
+            raise SelfSerializerError('Truncated record.')
+        tmp_dict, pos = dict(), 0
+        try:
+            for i in xrange(count):
+                name, pos = _read_bytes(body, pos)
+                tmp_dict[name], pos = _bin_decode(body, pos)
+        except (IndexError, struct.error):
+            raise SelfSerializerError('Truncated record.')
+        if pos != length:
+            raise SelfSerializerError('Record has trailing bytes.')
+        return tmp_dict
 
     def _is_serializable(self):
         for v in self.__dict__.itervalues():
@@ -81,68 +871,72 @@ class SelfSerializer(object):
         return True
 
     def _serialize(self, f, name, val):
-        if is_an_integer(val):
-            f.write('^i %s %d\n' % (name, val))
-        elif isinstance(val, str):
-            f.write('^b %s %d\n' % (name, len(val)))
-            f.write(val)
-        elif isinstance(val, list):
-            f.write('^a %s %d\n' % (name, len(val)))
-            for i, e in enumerate(val):
-                self._serialize(f, str(i), e)
-        elif isinstance(val, dict):
-            f.write('^h %s %d\n' % (name, len(val)))
-            keys = val.keys()
-            keys.sort()
-            for i, k in enumerate(keys):
-                ks = str(i)
-                self._serialize(f, ks, k)
-                self._serialize(f, ks, val[k])
-        elif isinstance(val, float):
-            hexflt = val.hex()
-            f.write('^f %s %d\n' % (name, len(hexflt)))
-            f.write(hexflt)
-        else:
-            raise ValueError("Can't serialize %s, %s." % (name, type(val)))
+        out = []
+        _encode(out, name, val)
+        f.write(''.join(out))
 
-    _type_re = re.compile(
-        '^\^(?P<type_>[ibahf])\s+(?P<name>\w+)\s+(?P<intval>-?\d+)$')
     def _deserialize(self, f):
-        L = f.readline()
-        M = SelfSerializer._type_re.match(L)
-        if M is None:
-            raise SelfSerializerError('Had trouble determining type.')
-        type_ = M.group('type_')
-        name = M.group('name')
-        intval = int(M.group('intval'))
-        if 'i' == type_:
-            return name, intval
-        elif 'b' == type_:
-            return name, f.read(intval)
-        elif 'a' == type_:
-            tmp = list()
-            for i in xrange(intval):
-                n, v = self._deserialize(f)
-                if n != str(i):
-                    raise SelfSerializerError(
-                        'Array element out of order.')
-                tmp.append(v)
-            return name, tmp
-        elif 'h' == type_:
-            tmp = dict()
-            for i in xrange(intval):
-                si = str(i)
-                n, k = self._deserialize(f)
-                if n != si:
-                    raise SelfSerializerError('dict key out of order.')
-                n, v = self._deserialize(f)
-                if n != si:
-                    raise SelfSerializerError('dict value out of order.')
-                tmp[k] = v
-            return name, tmp
-        elif 'f' == type_:
-            return name, float.fromhex(f.read(intval))
+        return _decode(f.readline, f.read)
 
 class SelfSerializingDataContainer(DataContainer, SelfSerializer):
+    '''
+    After a lazy load, the mapping methods count the items that haven't
+    been gotten at yet along with those that have.  The ones that hand
+    back values or change what's held materialize() first.
+    '''
     def __init__(self, *args, **kwargs):
         super(SelfSerializingDataContainer, self).__init__(*args, **kwargs)
+
+    def __contains__(self, item):
+        return item in self.__dict__ or item in self._pending()
+
+    def __len__(self):
+        return len(self.__dict__) + len(self._pending())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __delitem__(self, key):
+        self.materialize()
+        DataContainer.__delitem__(self, key)
+
+    def keys(self):
+        return self.__dict__.keys() + self._pending()
+
+    def iterkeys(self):
+        return iter(self.keys())
+
+    def values(self):
+        self.materialize()
+        return DataContainer.values(self)
+
+    def itervalues(self):
+        self.materialize()
+        return DataContainer.itervalues(self)
+
+    def items(self):
+        self.materialize()
+        return DataContainer.items(self)
+
+    def iteritems(self):
+        self.materialize()
+        return DataContainer.iteritems(self)
+
+    def get(self, key, default = None):
+        return getattr(self, key) if key in self else default
+
+    def clear(self):
+        _lazy_items.pop(id(self), None)
+        DataContainer.clear(self)
+
+    def pop(self, *args, **kwargs):
+        self.materialize()
+        return DataContainer.pop(self, *args, **kwargs)
+
+    def popitem(self):
+        self.materialize()
+        return DataContainer.popitem(self)
+
+    def copy(self):
+        self.materialize()
+        return DataContainer.copy(self)
@@ -1277,12 +1277,135 @@ def buffer_diff(buf0, buf1):
 
     return '\n'.join(ret)
 
-def hash_file(infile, algo = 'sha1'):
-    """Return digest of `infile` via hashlib's `algo`."""
+class HashCache(object):
+    """Remember file digests keyed by what `os.stat` says about the file.
+
+    An entry is keyed by the device, inode, size and modification and change
+    times of a file along with the hashlib algorithm name so that a file
+    that hasn't changed since it was last hashed doesn't have to be read
+    again.  Entries are appended to the file at `path` as they're made and
+    so are shared with other users of the same file.  `path` defaults to
+    ``hash-cache`` in the ``pu`` :func:`get_app_data_dir`.
+
+    Files modified in the last `racy_window` seconds aren't remembered since
+    a subsequent modification might not change their times.
+
+    """
+    racy_window = 2.0
+
+    def __init__(self, path = None):
+        if path is None:
+            path = os.path.join(get_app_data_dir('pu'), 'hash-cache')
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+        self.path = path
+        self._digests = {}
+        self._pos = 0
+        self._lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0644)
+        self._refresh()
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    @staticmethod
+    def key(st, algo):
+        """Return the cache key for the `os.stat` result `st` and `algo`."""
+        return (st.st_dev, st.st_ino, st.st_size, int(st.st_mtime * 1e9),
+            int(st.st_ctime * 1e9), algo)
+
+    def _check_open(self):
+        if self._fd is None:
+            raise ValueError('I/O operation on closed HashCache')
+
+    def _refresh(self):
+        self._check_open()
+        with self._lock:
+            if os.fstat(self._fd).st_size == self._pos: return
+            with open(self.path, 'rb') as f:
+                f.seek(self._pos)
+                data = f.read()
+            end = data.rfind('\n') + 1
+            for ln in data[:end].splitlines():
+                F = ln.split()
+                if 7 != len(F): continue
+                self._digests[tuple([int(x) for x in F[:5]] + [F[5]])] = F[6]
+            self._pos += end
+
+    def get(self, path, algo = 'sha1', st = None):
+        """Return the cached hex digest of `path` or None.
+
+        `st` can be given if `path` has already been stat()ed.
+
+        """
+        if st is None: st = os.stat(path)
+        key = HashCache.key(st, algo)
+        digest = self._digests.get(key)
+        if digest is None:
+            self._refresh()
+            digest = self._digests.get(key)
+        return digest
+
+    def put(self, st, algo, digest):
+        """Remember that the file that was stat()ed as `st` has `digest`."""
+        self._check_open()
+        if time.time() - st.st_mtime < self.racy_window:
+            return
+        key = HashCache.key(st, algo)
+        if self._digests.get(key) == digest: return
+        self._digests[key] = digest
+        os.write(self._fd, '%d %d %d %d %d %s %s\n' % (key + (digest,)))
+
+    def compact(self):
+        """Rewrite the cache file without superseded entries.
+
+        Of the entries for the same file and algorithm, the one with the
+        latest change time is kept since, unlike the modification time, it
+        can't be set back.
+
+        """
+        self._refresh()
+        latest = {}
+        with self._lock:
+            for key, digest in self._digests.iteritems():
+                file_algo = key[:2] + key[5:]
+                have = latest.get(file_algo)
+                if have is None or (have[0][4], have[0][3]) < (
+                        key[4], key[3]):
+                    latest[file_algo] = (key, digest)
+            fd, name = tempfile.mkstemp(dir = os.path.dirname(self.path))
+            try:
+                os.write(fd, ''.join(['%d %d %d %d %d %s %s\n' % (
+                    key + (digest,)) for key, digest in latest.itervalues()]))
+            finally:
+                os.close(fd)
+            os.rename(name, self.path)
+            os.close(self._fd)
+            self._fd = os.open(self.path, os.O_RDWR | os.O_APPEND)
+            self._digests = dict(latest.itervalues())
+            self._pos = os.fstat(self._fd).st_size
+
+def hash_file(infile, algo = 'sha1', cache = None):
+    """Return digest of `infile` via hashlib's `algo`.
+
+    If `cache` is a :class:`HashCache`, then it's consulted first and
+    updated afterwards.
+
+    """
+    st = None
+    if cache is not None:
+        st = os.stat(infile)
+        digest = cache.get(infile, algo, st)
+        if digest is not None: return digest.decode('hex')
 
     hsh = getattr(hashlib, algo)()
     with open(infile, 'rb') as f:
-        hsh.update(f.read())
+        if cache is not None: st = os.fstat(f.fileno())
+        for buf in iter(lambda: f.read(1 << 20), ''):
+            hsh.update(buf)
+    if cache is not None: cache.put(st, algo, hsh.hexdigest())
     return hsh.digest()
 
 def repl_edit(filename = None):
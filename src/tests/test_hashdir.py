@@ -0,0 +1,783 @@
+#
+# Copyright (c) 2012 Joshua Hughes <kivhift@gmail.com>
+#
+import errno
+import hashlib
+import multiprocessing
+import os
+import shutil
+import StringIO
+import struct
+import tempfile
+import threading
+import time
+
+from nose.tools import assert_raises
+
+import pu.hashdir
+import pu.utils
+
+def _sha1(s):
+    return hashlib.sha1(s).hexdigest()
+
+def _racing_adds(job):
+    # Run in a pool worker process by test_concurrent_adds.
+    root, big, i = job
+    hd = pu.hashdir.HashDir(root, lock_inflight = True)
+    return [hd.addFile(big), hd.add_bytes('small %d' % (i % 2)),
+        hd.addFile(StringIO.StringIO('streamed'))]
+
+class TestHashDir(object):
+    def setup(self):
+        self.tmp = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmp, 'root')
+        os.mkdir(self.root)
+        self.hd = pu.hashdir.HashDir(self.root)
+
+    def teardown(self):
+        shutil.rmtree(self.tmp)
+
+    def make_file(self, name, content):
+        path = os.path.join(self.tmp, name)
+        d = os.path.dirname(path)
+        if not os.path.isdir(d): os.makedirs(d)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def test_addFile(self):
+        hd = self.hd
+        d = hd.addFile(StringIO.StringIO('some content'))
+        assert _sha1('some content') == d
+        assert os.path.isfile(hd.pathFromHexDigest(d))
+        assert d == hd.addFile(self.make_file('a', 'some content'))
+        with hd.openFileFromHexDigest(d) as f:
+            assert 'some content' == f.read()
+
+    def test_add_file_closes(self):
+        pu.hashdir.HashDir(self.root, index = True, stats = True).close()
+        fds = len(os.listdir('/proc/self/fd'))
+        for i in xrange(20):
+            pu.hashdir.add_file(StringIO.StringIO('%d' % i), self.root)
+        assert fds == len(os.listdir('/proc/self/fd'))
+
+    def test_add_files(self):
+        contents = ['%d' % i * (i * 1000) for i in xrange(20)]
+        paths = [self.make_file('f%02d' % i, c)
+            for i, c in enumerate(contents)]
+        paths.insert(3, os.path.join(self.tmp, 'not-there'))
+        digests, failures = self.hd.add_files(paths, workers = 4)
+        assert len(paths) == len(digests)
+        assert digests[3] is None
+        assert 1 == len(failures) and paths[3] == failures[0][0]
+        del digests[3]
+        assert [_sha1(c) for c in contents] == digests
+
+    def test_add_tree(self):
+        self.make_file(os.path.join('t', 'x'), 'x')
+        self.make_file(os.path.join('t', 'sub', 'y'), 'y')
+        paths, digests, failures = self.hd.add_tree(
+            os.path.join(self.tmp, 't'))
+        assert not failures
+        assert [_sha1('x'), _sha1('y')] == digests
+
+    def test_index(self):
+        hd = self.hd
+        d0 = hd.addFile(StringIO.StringIO('before the index'))
+        hd = pu.hashdir.HashDir(self.root, index = True)
+        assert os.path.isfile(os.path.join(self.root, '.hashdir', 'index'))
+        assert hd.has_digest(d0)
+        d1 = hd.addFile(StringIO.StringIO('after'))
+        assert 5 == hd.size_of(d1)
+        assert hd.size_of(_sha1('nope')) is None
+        # Another writer's adds are seen via the log.
+        other = pu.hashdir.HashDir(self.root)
+        d2 = other.addFile(StringIO.StringIO('from elsewhere'))
+        assert set([d0, d2]) == hd.have_digests([d0, d2, _sha1('nope')])
+        os.remove(os.path.join(self.root, '.hashdir', 'index'))
+        hd.rebuild_index()
+        assert set([d0, d1, d2]) == hd.have_digests([d0, d1, d2])
+
+    def test_index_replaced(self):
+        # A HashDir opened before the index was built or rebuilt keeps it
+        # up to date.
+        early = pu.hashdir.HashDir(self.root)
+        builder = pu.hashdir.HashDir(self.root, index = True)
+        d0 = early.add_bytes('added by a HashDir opened earlier')
+        fresh = pu.hashdir.HashDir(self.root)
+        assert fresh.has_digest(d0) and 33 == fresh.size_of(d0)
+        builder.rebuild_index()
+        d1 = early.add_bytes('added after a rebuild')
+        d2 = fresh.add_bytes('added by another')
+        for hd in (pu.hashdir.HashDir(self.root), builder, early):
+            assert set([d0, d1, d2]) == hd.have_digests([d0, d1, d2])
+            assert 21 == hd.size_of(d1)
+        for hd in (early, builder, fresh): hd.close()
+
+    def test_add_large_file(self):
+        content = os.urandom(3 * pu.hashdir.HashDir._mmap_threshold + 17)
+        path = self.make_file('big', content)
+        for hd in [self.hd, pu.hashdir.HashDir(self.root, link = True)]:
+            d = hd.addFile(path)
+            assert _sha1(content) == d
+            with hd.openFileFromHexDigest(d) as f:
+                assert content == f.read()
+        assert [] == [n for n in os.listdir(self.root) if n.startswith('tmp')]
+        hd = pu.hashdir.HashDir(self.root, link = True)
+        other = self.make_file('other', content[:-1])
+        d = hd.addFile(other)
+        assert _sha1(content[:-1]) == d
+        assert os.path.samefile(other, hd.pathFromHexDigest(d))
+
+    def test_repack(self):
+        hd = self.hd
+        small = ['small %d' % i for i in xrange(50)]
+        digests = [hd.addFile(StringIO.StringIO(c)) for c in small]
+        big = hd.addFile(StringIO.StringIO('x' * 5000))
+        assert 50 == hd.repack()
+        assert not os.path.exists(hd.pathFromHexDigest(digests[7]))
+        assert os.path.exists(hd.pathFromHexDigest(big))
+        hd = pu.hashdir.HashDir(self.root)
+        for d, c in zip(digests, small):
+            assert hd.has_digest(d)
+            assert len(c) == hd.size_of(d)
+            with hd.openFileFromHexDigest(d) as f:
+                assert c[:3] == f.read(3)
+                assert c[3:] == f.read()
+                assert '' == f.read()
+                f.seek(-2, os.SEEK_END)
+                assert c[-2:] == f.read()
+        assert digests[0] == hd.addFile(StringIO.StringIO(small[0]))
+        assert not os.path.exists(hd.pathFromHexDigest(digests[0]))
+        hd.rebuild_index()
+        assert set(digests + [big]) == hd.have_digests(digests + [big])
+        assert 0 == hd.repack()
+        hd.close()
+
+    def test_codec(self):
+        content = 'compress me, please.\n' * 1000
+        hd = pu.hashdir.HashDir(self.root, codec = 'zlib')
+        d = hd.addFile(StringIO.StringIO(content))
+        assert _sha1(content) == d
+        assert os.stat(hd.pathFromHexDigest(d)).st_size < len(content) // 10
+        assert len(content) == hd.size_of(d)
+        with pu.hashdir.HashDir(self.root) as hd:
+            assert 'zlib' == hd.codec
+            assert d == hd.addFile(self.make_file('c', content))
+            with hd.openFileFromHexDigest(d) as f:
+                assert content[:21] == f.read(21)
+                f.seek(-5, os.SEEK_END)
+                assert content[-5:] == f.read()
+                f.seek(2)
+                assert content[2:] == f.read()
+            hd.repack()
+            with hd.openFileFromHexDigest(d) as f:
+                assert content == f.read()
+        with assert_raises(ValueError):
+            pu.hashdir.HashDir(self.root, codec = 'zlib-ish')
+        with assert_raises(ValueError):
+            pu.hashdir.HashDir(self.root, codec = '')
+
+    def test_add_chunked(self):
+        hd = self.hd
+        base = os.urandom(1 << 20)
+        changed = base[:300000] + 'a change' + base[300008:]
+        d0 = hd.add_chunked(StringIO.StringIO(base))
+        n0 = len(list(hd.iter_objects()))
+        d1 = hd.add_chunked(self.make_file('changed', changed))
+        n1 = len(list(hd.iter_objects()))
+        assert _sha1(base) == d0 and _sha1(changed) == d1
+        assert n1 - n0 <= 2
+        assert len(changed) == hd.size_of(d1)
+        assert hd.has_digest(d1)
+        with hd.openFileFromHexDigest(d1) as f:
+            assert changed == f.read()
+            f.seek(299990)
+            assert changed[299990:300020] == f.read(30)
+        assert d0 == hd.addFile(StringIO.StringIO(base))
+        hd.rebuild_index()
+        assert len(base) == hd.size_of(d0)
+
+    def test_hash_cache(self):
+        path = self.make_file('cached', 'cache my digest')
+        then = time.time() - 60
+        os.utime(path, (then, then))
+        hd = pu.hashdir.HashDir(self.root, hash_cache = True)
+        d = hd.addFile(path)
+        assert d == hd.hash_cache.get(path)
+        # Only the cache and the hashdir's objects are consulted now.
+        other = hd.addFile(StringIO.StringIO('other'))
+        hd.hash_cache.put(os.stat(path), 'sha1', other)
+        assert other == hd.addFile(path)
+        hd.close()
+        assert_raises(ValueError, hd.hash_cache.put, os.stat(path), 'sha1',
+            other)
+
+        # A cache that's handed in is left open for its other users.
+        cache = pu.utils.HashCache(os.path.join(self.tmp, 'shared-cache'))
+        with pu.hashdir.HashDir(self.root, hash_cache = cache) as hd:
+            hd.addFile(path)
+        with pu.hashdir.HashDir(self.root, hash_cache = cache) as hd:
+            hd.addFile(self.make_file('again', 'cache me too'))
+        assert list(pu.hashdir.find_duplicates([self.tmp],
+            hash_cache = cache))
+        cache.close()
+
+    def test_algo(self):
+        content = 'digest me' * 100
+        hd = pu.hashdir.HashDir(self.root, algo = 'sha256')
+        digests = hd.add_file_digests(StringIO.StringIO(content),
+            ['md5', 'sha1'])
+        d = digests['sha256']
+        assert hashlib.sha256(content).hexdigest() == d
+        assert _sha1(content) == digests['sha1']
+        assert hashlib.md5(content).hexdigest() == digests['md5']
+        with pu.hashdir.HashDir(self.root) as hd:
+            assert 'sha256' == hd.algo
+            assert d == hd.addFile(self.make_file('f', content))
+            assert os.path.isfile(hd.pathFromHexDigest(d))
+            hd.repack()
+            with hd.openFileFromHexDigest(d) as f:
+                assert content == f.read()
+        with assert_raises(ValueError):
+            pu.hashdir.HashDir(self.root, algo = 'md5')
+        with assert_raises(ValueError):
+            pu.hashdir.HashDir(self.tmp, algo = 'no-such-algo')
+
+    def test_verify(self):
+        hd = self.hd
+        digests = [hd.addFile(StringIO.StringIO('object %d' % i * 100))
+            for i in xrange(8)]
+        result = hd.verify()
+        assert result.complete and 8 == result.checked
+        assert not (result.corrupt or result.truncated or result.stray)
+
+        with open(hd.pathFromHexDigest(digests[0]), 'wb') as f:
+            f.write('not what it was')
+        open(hd.pathFromHexDigest(digests[1]), 'wb').close()
+        stray = os.path.join(self.root, 'tmpstray')
+        open(stray, 'wb').close()
+        then = time.time() - 2 * pu.hashdir.HashDir._stray_age
+        os.utime(stray, (then, then))
+
+        result = hd.verify(time_limit = 0)
+        assert not result.complete
+        checked = result.checked
+        corrupt, truncated = result.corrupt, result.truncated
+        while not result.complete:
+            result = hd.verify(resume = True, time_limit = 0)
+            checked += result.checked
+            corrupt += result.corrupt
+            truncated += result.truncated
+        assert 8 == checked
+        assert [digests[0]] == corrupt
+        assert [digests[1]] == truncated
+        assert [stray] == result.stray
+
+    def test_fanout(self):
+        hd = pu.hashdir.HashDir(self.root, fanout = (2, 1))
+        d0 = hd.addFile(StringIO.StringIO('deep'))
+        assert os.path.isfile(os.path.join(self.root, d0[0], d0[1], d0[2:]))
+        with assert_raises(ValueError):
+            pu.hashdir.HashDir(self.root, fanout = (1, 2))
+
+    def test_reshard(self):
+        hd = self.hd
+        contents = ['reshard %d' % i for i in xrange(30)]
+        digests = [hd.addFile(StringIO.StringIO(c)) for c in contents]
+        reader = pu.hashdir.HashDir(self.root)
+        assert 30 == hd.reshard(2, 2)
+        assert (2, 2) == hd.fanout
+        d = digests[0]
+        assert os.path.isfile(os.path.join(self.root, d[:2], d[2:4], d[4:]))
+        # The reader picks the new layout up when it misses.
+        for d, c in zip(digests, contents):
+            with reader.openFileFromHexDigest(d) as f:
+                assert c == f.read()
+        assert (2, 2) == reader.fanout
+        assert 0 == hd.reshard(2, 2)
+        assert 30 == hd.reshard(1, 2)
+        assert set(digests) == set([d for d, p in hd.iter_objects()])
+        for name in os.listdir(self.root):
+            if '.hashdir' != name:
+                assert 2 == len(name)
+                assert [] == [n for n in os.listdir(
+                    os.path.join(self.root, name)) if 2 == len(n)]
+        assert 30 == hd.verify().checked
+
+    def test_contains_many(self):
+        hd = self.hd
+        before = [hd.addFile(StringIO.StringIO('b%d' % i)) for i in xrange(5)]
+        absent = [_sha1('absent %d' % i) for i in xrange(1000)]
+        assert set(before) == hd.contains_many(before + absent)
+        hd = pu.hashdir.HashDir(self.root, bloom = True)
+        assert os.path.isfile(os.path.join(self.root, '.hashdir', 'bloom'))
+        after = [hd.addFile(StringIO.StringIO('a%d' % i)) for i in xrange(5)]
+        other = pu.hashdir.HashDir(self.root)
+        another = other.addFile(StringIO.StringIO('another'))
+        present = before + after + [another]
+        assert set(present) == hd.contains_many(present + absent)
+        might = [d for d in absent if hd._bloom.might_contain(d)]
+        assert len(might) < 50
+        hd.close()
+        other.close()
+
+    def test_bloom_replaced(self):
+        # Adds through a filter that another HashDir has since rebuilt go
+        # to the new filter.
+        early = pu.hashdir.HashDir(self.root)
+        builder = pu.hashdir.HashDir(self.root, bloom = True)
+        d0 = early.add_bytes('added by a HashDir opened earlier')
+        builder.rebuild_bloom()
+        d1 = early.add_bytes('added after a rebuild')
+        for hd in (pu.hashdir.HashDir(self.root), builder, early):
+            assert set([d0, d1]) == hd.contains_many([d0, d1])
+            hd.close()
+
+    def test_sync(self):
+        src = self.hd
+        digests = [src.addFile(StringIO.StringIO('s%d' % i * 1000))
+            for i in xrange(10)]
+        os.mkdir(os.path.join(self.tmp, 'dst'))
+        dst = pu.hashdir.HashDir(os.path.join(self.tmp, 'dst'), index = True)
+        dst.addFile(StringIO.StringIO('s0' * 1000))
+        dst_only = dst.addFile(StringIO.StringIO('only in dst'))
+        copied, failures = pu.hashdir.sync(src, dst, workers = 2)
+        assert [] == failures
+        assert sorted(digests[1:]) == sorted(copied)
+        assert src.bucket_summaries() != dst.bucket_summaries()
+        assert ([], []) == pu.hashdir.sync(src, dst)
+
+        with pu.hashdir.HashDirPipe.spawn(dst.rootdir) as peer:
+            assert 'sha1' == peer.algo
+            assert 11 == sum([len(peer.bucket_digests(p))
+                for p in peer.bucket_summaries()])
+            assert None == peer.size_of(_sha1('absent'))
+            assert_raises(IOError, peer.openFileFromHexDigest,
+                _sha1('absent'))
+            assert ([dst_only], []) == pu.hashdir.sync(peer, src)
+            with src.openFileFromHexDigest(dst_only) as f:
+                assert 'only in dst' == f.read()
+            new = src.addFile(StringIO.StringIO('n' * 200000))
+            assert ([new], []) == pu.hashdir.sync(src, peer, workers = 4)
+            with peer.openFileFromHexDigest(new) as f:
+                assert 'n' * 1000 == f.read(1000)
+            assert 2 * 1000 == peer.size_of(digests[1])
+        assert src.bucket_summaries() == dst.bucket_summaries()
+        dst.close()
+
+        # bucket_digests() doesn't hand out a stale snapshot forever.
+        src.bucket_summaries()
+        later = src.add_bytes('added later')
+        assert later not in src.bucket_digests(later[:2])
+        src._buckets_taken -= src._buckets_ttl + 1
+        assert later in src.bucket_digests(later[:2])
+
+    def test_serve_failed_put(self):
+        class Full(object):
+            algo = 'sha1'
+            def addFile(self, f):
+                f.read(3)
+                raise IOError(errno.ENOSPC, 'No space left')
+        fin = StringIO.StringIO('put\n5\nhello5\nworld0\nalgo\n')
+        fout = StringIO.StringIO()
+        pu.hashdir.serve(Full(), fin, fout)
+        assert ('![Errno %d] No space left\n\nsha1\n\n' % errno.ENOSPC
+            ) == fout.getvalue()
+
+    def test_async(self):
+        got = []
+        with pu.hashdir.AsyncHashDir(self.hd, workers = 2) as ahd:
+            r0 = ahd.add(StringIO.StringIO('plain'), callback = got.append)
+            r1 = ahd.add(('chunk %d ' % i for i in xrange(1000)))
+            with ahd.stream() as sa:
+                for i in xrange(100): sa.write('streamed %d ' % i)
+            r2 = sa.result
+            sa = ahd.stream()
+            sa.write('never finished')
+            sa.abort()
+            assert_raises(IOError, sa.result.get)
+            assert _sha1('plain') == r0.get()
+            body = ''.join(['chunk %d ' % i for i in xrange(1000)])
+            assert _sha1(body) == r1.get()
+            streamed = ''.join(['streamed %d ' % i for i in xrange(100)])
+            assert _sha1(streamed) == r2.get()
+            assert body == ''.join(ahd.read(r1.get(), chunk_size = 100))
+            for buf in ahd.read(r1.get(), chunk_size = 10): break
+            assert 'chunk 0 ch' == buf
+            with ahd.open(r2.get()).get() as f:
+                assert streamed == f.read()
+            assert_raises(IOError, list, ahd.read(_sha1('absent')))
+        assert [_sha1('plain')] == got
+
+    def test_async_more_streams_than_workers(self):
+        results = []
+        def interleave():
+            with pu.hashdir.AsyncHashDir(self.hd, workers = 2) as ahd:
+                streams = [ahd.stream(max_chunks = 2) for i in xrange(3)]
+                for i in xrange(10):
+                    for j, sa in enumerate(streams):
+                        sa.write('%d:%d ' % (j, i))
+                results.extend([sa.close().get() for sa in streams])
+                readers = [ahd.read(d, chunk_size = 2, max_chunks = 1)
+                    for d in results]
+                results.extend([''.join(parts) for parts in zip(*readers)])
+        t = threading.Thread(target = interleave)
+        t.daemon = True
+        t.start()
+        t.join(30)
+        assert not t.is_alive()
+        contents = [''.join(['%d:%d ' % (j, i) for i in xrange(10)])
+            for j in xrange(3)]
+        assert [_sha1(c) for c in contents] == results[:3]
+        assert [''.join(parts) for parts in zip(*[
+            [c[k : k + 2] for k in xrange(0, len(c), 2)] for c in contents])
+            ] == results[3:]
+
+    def age(self, seconds, root = None):
+        then = time.time() - seconds
+        for dpath, dnames, fnames in os.walk(root or self.root):
+            for name in fnames:
+                os.utime(os.path.join(dpath, name), (then, then))
+
+    def test_gc_seen_by_others(self):
+        # An add through a HashDir that knew of an object before another
+        # one collected it puts the object back.
+        for index in (False, True):
+            root = os.path.join(self.tmp, 'index' if index else 'plain')
+            os.mkdir(root)
+            hd = pu.hashdir.HashDir(root, index = index)
+            packed = hd.add_bytes('packed')
+            assert 1 == hd.repack(threshold = 100)
+            loose = hd.add_bytes('loose' * 1000)
+            hd.set_ref('keep', [])
+            assert hd.has_digest(packed) and hd.has_digest(loose)
+            self.age(7200, root)
+            assert 2 == pu.hashdir.HashDir(root).gc().removed
+            assert packed == hd.add_bytes('packed')
+            assert loose == hd.add_bytes(buffer('loose' * 1000))
+            assert loose == hd.addFile(StringIO.StringIO('loose' * 1000))
+            other = pu.hashdir.HashDir(root)
+            with other.openFileFromHexDigest(packed) as f:
+                assert 'packed' == f.read()
+            assert 5000 == other.size_of(loose)
+            hd.close()
+            other.close()
+
+    def test_gc(self):
+        hd = pu.hashdir.HashDir(self.root, index = True)
+        assert_raises(ValueError, hd.gc)
+        loose = [hd.addFile(StringIO.StringIO('loose %d' % i * 1000))
+            for i in xrange(4)]
+        hd.repack(threshold = 100)
+        packed = [hd.addFile(StringIO.StringIO('packed %d' % i))
+            for i in xrange(4)]
+        assert 4 == hd.repack(threshold = 100)
+        content = os.urandom(1 << 19)
+        chunked = hd.add_chunked(StringIO.StringIO(content))
+        # Longer than a chunk can be so that there's a manifest.
+        dead_chunked = hd.add_chunked(StringIO.StringIO(
+            os.urandom(2 * hd._chunk_max)))
+        chunks = [d for d, length in hd._read_manifest(chunked)]
+        dead_chunks = [d for d, length in hd._read_manifest(dead_chunked)]
+
+        assert_raises(ValueError, hd.set_ref, '.hidden', [])
+        assert_raises(ValueError, hd.set_ref, 'bad', ['not a digest'])
+        hd.set_ref('keep', loose[:2] + packed[:2] + [chunked])
+        hd.set_ref('gone', loose[2:])
+        assert ['gone', 'keep'] == hd.refs()
+        assert loose[2:] == list(hd.iter_ref('gone'))
+        hd.delete_ref('gone')
+        assert ['keep'] == hd.refs()
+
+        result = hd.gc()
+        assert 0 == result.removed
+        assert 5 + len(dead_chunks) == result.recent
+
+        self.age(7200)
+        result = hd.gc(workers = 2)
+        assert 5 + len(chunks) == result.marked
+        assert 5 + len(dead_chunks) == result.removed
+        assert 0 == result.recent
+        for d in loose[2:] + packed[2:] + [dead_chunked] + dead_chunks:
+            assert not hd.has_digest(d)
+            assert not os.path.exists(hd.pathFromHexDigest(d))
+        for d in loose[:2] + packed[:2]:
+            assert hd.has_digest(d)
+        with hd.openFileFromHexDigest(packed[0]) as f:
+            assert 'packed 0' == f.read()
+        with hd.openFileFromHexDigest(chunked) as f:
+            assert content == f.read()
+        assert 1 == len(os.listdir(os.path.join(self.root, '.hashdir',
+            'packs'))) // 2
+
+        # Adding an object again freshens it against the grace period.
+        hd.addFile(StringIO.StringIO('loose 2' * 1000))
+        self.age(7200)
+        hd.addFile(StringIO.StringIO('loose 2' * 1000))
+        result = hd.gc()
+        assert 0 == result.removed and 1 == result.recent
+        hd.close()
+
+    def test_sorted_unique(self):
+        strings = ['%03d' % (i * 7 % 100) for i in xrange(250)]
+        path = pu.hashdir._sorted_unique(iter(strings), self.tmp, 16)
+        with open(path, 'rb') as f:
+            assert sorted(set(strings)) == f.read().splitlines()
+        sd = pu.hashdir._SortedDigests(path, 3)
+        assert 100 == sd.count
+        assert '042' in sd and '100' not in sd
+        sd.close()
+        assert [os.path.basename(path)] == [n for n in os.listdir(self.tmp)
+            if n.startswith('tmp')]
+
+    def test_add_bytes(self):
+        hd = self.hd
+        for buf in ('as str', bytearray('as bytearray'),
+                memoryview('as memoryview'), buffer('xas buffer', 1)):
+            d = hd.add_bytes(buf)
+            assert _sha1(str(buf) if not isinstance(buf, memoryview)
+                else buf.tobytes()) == d
+            with hd.openFileFromHexDigest(d) as f:
+                assert _sha1(f.read()) == d
+        def place(*args):
+            raise AssertionError('Extant content written again')
+        hd._place = place
+        assert _sha1('as str') == hd.add_bytes(bytearray('as str'))
+        del hd._place
+        # A memoryview is hashed and written without being copied out.
+        view = memoryview(bytearray('xa sliced memoryview'))[1:]
+        assert view is pu.hashdir._as_buffer(view)
+        d = hd.add_bytes(view)
+        with hd.openFileFromHexDigest(d) as f:
+            assert 'a sliced memoryview' == f.read()
+
+        os.mkdir(os.path.join(self.tmp, 'z'))
+        zhd = pu.hashdir.HashDir(os.path.join(self.tmp, 'z'), codec = 'zlib')
+        for content, wrap in (('z' * 10000, bytearray),
+                ('y' * 10000, memoryview)):
+            d = zhd.add_bytes(wrap(content))
+            with zhd.openFileFromHexDigest(d) as f:
+                assert content == f.read()
+
+    def test_add_buffers(self):
+        hd = self.hd
+        bufs = ['buf %d' % (i % 30) for i in xrange(50)]
+        hd.add_bytes(bufs[3])
+        digests = hd.add_buffers([bytearray(b) for b in bufs], fsync = True)
+        assert [_sha1(b) for b in bufs] == digests
+        assert 30 == len(list(hd.iter_objects()))
+        assert [] == [n for n in os.listdir(self.root) if n.startswith('tmp')]
+        assert digests[:5] == hd.add_buffers(bufs[:5])
+
+    def test_durability(self):
+        assert_raises(ValueError, pu.hashdir.HashDir, self.root,
+            durability = 'some')
+        synced = []
+        real_fsync_path = pu.hashdir._fsync_path
+        def fsync_path(path):
+            synced.append(path)
+            real_fsync_path(path)
+        pu.hashdir._fsync_path = fsync_path
+        try:
+            paths = [self.make_file('f%02d' % i, 'file %d' % i)
+                for i in xrange(20)]
+            hd = pu.hashdir.HashDir(self.root, durability = 'group')
+            digests, failures = hd.add_files(paths, workers = 4)
+            # The temporary files are flushed and only then the directories
+            # that they were moved into.
+            files, dirs = synced[:20], synced[20:]
+            assert 20 == len(set(files))
+            assert all([os.path.basename(p).startswith('tmp')
+                for p in files])
+            assert sorted(set([self.root] + [os.path.dirname(
+                hd.pathFromHexDigest(d)) for d in digests])) == dirs
+
+            del synced[:]
+            assert digests == hd.add_files(paths, workers = 4)[0]
+            assert len(synced) == len(dirs)
+
+            del synced[:]
+            hd = pu.hashdir.HashDir(self.root, durability = 'object')
+            d = hd.addFile(StringIO.StringIO('lone'))
+            assert [self.root, os.path.dirname(hd.pathFromHexDigest(d))] \
+                == synced[1:]
+
+            del synced[:]
+            hd = pu.hashdir.HashDir(self.root)
+            hd.add_buffers(['a', 'b'])
+            hd.addFile(StringIO.StringIO('c'))
+            assert [] == synced
+            hd.add_buffers(['d', 'e'], fsync = True)
+            assert 2 + 3 == len(synced)
+        finally:
+            pu.hashdir._fsync_path = real_fsync_path
+
+    def test_concurrent_adds(self):
+        hd = pu.hashdir.HashDir(self.root, index = True)
+        content = 'big' * (pu.hashdir.HashDir._mmap_threshold // 2)
+        big = self.make_file('big', content)
+        pool = multiprocessing.Pool(4)
+        try:
+            results = pool.map(_racing_adds,
+                [(self.root, big, i) for i in xrange(16)])
+        finally:
+            pool.close()
+            pool.join()
+        expected = [_sha1(content), None, _sha1('streamed')]
+        for i, digests in enumerate(results):
+            expected[1] = _sha1('small %d' % (i % 2))
+            assert expected == digests
+        assert 4 == len(list(hd.iter_objects()))
+        hd._index.refresh()
+        assert 4 == len(hd._index.sizes)
+        assert [] == os.listdir(os.path.join(self.root, '.hashdir', 'locks'))
+        assert [] == [n for n in os.listdir(self.root) if n.startswith('tmp')]
+
+        # A writer that loses the race leaves the winner's object be.
+        path = hd.pathFromHexDigest(_sha1(content))
+        ino = os.stat(path).st_ino
+        fd, name = tempfile.mkstemp(dir = self.root)
+        os.write(fd, content)
+        os.close(fd)
+        assert not pu.hashdir._publish(name, path)
+        assert ino == os.stat(path).st_ino
+        hd._has_object = lambda digest: False
+        hd._place(name, _sha1(content), len(content))
+        assert not os.path.exists(name)
+        assert ino == os.stat(path).st_ino
+
+        # So does one on a platform without link().
+        real_link = os.link
+        del os.link
+        try:
+            fd, name = tempfile.mkstemp(dir = self.root)
+            os.close(fd)
+            assert not pu.hashdir._publish(name, path)
+            assert ino == os.stat(path).st_ino
+            assert pu.hashdir._publish(name, path + '.new')
+            assert not os.path.exists(name)
+            hd = pu.hashdir.HashDir(self.root, link = True)
+            other = self.make_file('other', content + 'x')
+            d = hd.addFile(other)
+            with hd.openFileFromHexDigest(d) as f:
+                assert content + 'x' == f.read()
+        finally:
+            os.link = real_link
+
+    def test_find_duplicates(self):
+        big = os.urandom(20000)
+        flip = lambda i: big[:i] + chr(ord(big[i]) ^ 1) + big[i + 1:]
+        files = dict(
+            a = 'same', b = 'same', c = 'diff', d = '',
+            e = big, f = big, g = flip(len(big) - 1), h = flip(0),
+            i = flip(10000), j = flip(10000))
+        for name, content in files.iteritems():
+            self.make_file(os.path.join('t', name[0] < 'f' and 'one'
+                or 'two', name), content)
+        e = self.make_file('e2', big)
+        join = lambda *names: os.path.join(self.tmp, 't', *names)
+        groups = sorted(pu.hashdir.find_duplicates(
+            [os.path.join(self.tmp, 't'), e, e], workers = 2, edge = 64))
+        assert [[e, join('one', 'e'), join('two', 'f')],
+            [join('one', 'a'), join('one', 'b')],
+            [join('two', 'i'), join('two', 'j')]] == groups
+        assert [] == list(pu.hashdir.find_duplicates(join('one', 'a')))
+        assert 1 == len(list(pu.hashdir.find_duplicates(join('one'),
+            min_size = 0, edge = 4)))
+
+    def test_read_range(self):
+        hd = self.hd
+        content = ''.join([struct.pack('>I', i) for i in xrange(5000)])
+        digests = [hd.addFile(StringIO.StringIO(c))
+            for c in (content, 'packed one', 'packed two', '')]
+        hd.repack(threshold = 100)
+        chunked = hd.add_chunked(StringIO.StringIO(os.urandom(1 << 19)))
+        big, one, two, empty = digests
+        assert content[400:408] == hd.read_range(big, 400, 8)
+        assert content[-3:] == hd.read_range(big, len(content) - 3, 100)
+        assert content[19996:] == hd.read_range(big, 19996)
+        assert '' == hd.read_range(big, len(content) + 1, 10)
+        assert 'one' == hd.read_range(one, 7)
+        assert 'two' == hd.read_range(two, 7, 3)
+        assert '' == hd.read_range(empty, 0, 10)
+        assert_raises(ValueError, hd.read_range, big, -1)
+        assert_raises(IOError, hd.read_range, _sha1('absent'), 0)
+        with hd.openFileFromHexDigest(chunked) as f:
+            f.seek(300000)
+            assert f.read(70000) == hd.read_range(chunked, 300000, 70000)
+
+        view = hd.map(big)
+        assert (1234,) == struct.unpack_from('>I', view, 4 * 1234)
+        assert 'packed two' == str(hd.map(two))
+        assert '' == str(hd.map(empty))
+        assert 1 << 19 == len(hd.map(chunked))
+
+        hd._handles.clear()
+        hd._handle_cache_size = 2
+        for d in digests: hd.read_range(d, 0, 1)
+        assert [two, empty] == hd._handles.keys()
+        hd.close()
+        assert (4999,) == struct.unpack_from('>I', view, len(content) - 4)
+
+        os.mkdir(os.path.join(self.tmp, 'z'))
+        zhd = pu.hashdir.HashDir(os.path.join(self.tmp, 'z'), codec = 'zlib')
+        d = zhd.addFile(StringIO.StringIO(content))
+        assert content[400:408] == zhd.read_range(d, 400, 8)
+        assert content == str(zhd.map(d))
+
+    def check_stats(self, hd):
+        # The running totals have to match a recount.
+        running = hd.stats()
+        hd.rebuild_stats()
+        assert vars(hd.stats()) == vars(running)
+        return running
+
+    def test_stats(self):
+        hd = self.hd
+        assert None == hd.stats()
+        for i in xrange(5): hd.addFile(StringIO.StringIO('x' * (10 ** i)))
+        hd = pu.hashdir.HashDir(self.root, stats = True)
+        stats = hd.stats()
+        assert 5 == stats.objects
+        assert 11111 == stats.logical_bytes == stats.physical_bytes
+        assert [0, 1, 0, 0, 1, 0, 0, 1, 0, 0, 1, 0, 0, 0, 1] == \
+            stats.histogram[:15]
+        assert 5 == sum(stats.histogram)
+
+        hd.addFile(StringIO.StringIO('x'))
+        hd.add_bytes('')
+        hd.add_buffers(['y' * 100, 'z' * 100])
+        hd.repack(threshold = 50)
+        indexed = pu.hashdir.HashDir(self.root, index = True)
+        chunked = hd.add_chunked(StringIO.StringIO(os.urandom(1 << 19)))
+        # The index has the whole size of chunked content.
+        assert 1 << 19 == indexed.size_of(chunked) == hd.size_of(chunked)
+        indexed.close()
+        stats = self.check_stats(hd)
+        assert 1 + len(hd._read_manifest(chunked)) + 8 == stats.objects
+        # The empty object and the manifest.
+        assert 2 == stats.histogram[0]
+        assert 11111 + 200 + (1 << 19) == stats.logical_bytes
+
+        hd.set_ref('keep', [chunked])
+        self.age(7200)
+        hd.gc()
+        stats = self.check_stats(hd)
+        assert 1 + len(hd._read_manifest(chunked)) == stats.objects
+        assert 1 << 19 == stats.logical_bytes
+
+        with open(os.path.join(self.root, '.hashdir', 'stats'), 'r+b') as f:
+            f.seek(20)
+            f.write('\xff')
+        assert_raises(IOError, hd.stats)
+        hd.rebuild_stats()
+        assert vars(stats) == vars(hd.stats())
+        hd.close()
+
+        os.mkdir(os.path.join(self.tmp, 'z'))
+        zhd = pu.hashdir.HashDir(os.path.join(self.tmp, 'z'), codec = 'zlib',
+            stats = True)
+        zhd.addFile(StringIO.StringIO('z' * 10000))
+        stats = self.check_stats(zhd)
+        assert 10000 == stats.logical_bytes > stats.physical_bytes
@@ -3,8 +3,10 @@
 #
 from nose.tools import assert_raises
 
+import array
 import os
 import StringIO
+import struct
 import tempfile
 
 import pu.serializer
@@ -29,7 +31,7 @@ class EqHelper(pu.serializer.SelfSerializer):
     def __ne__(self, other):
         return not self.__eq__(other)
 
-def test_serializability():
+def _everything():
     s = EqHelper()
     # ints
     s.a = 0
@@ -54,7 +56,10 @@ def test_serializability():
     # dict
     s.q = {}
     s.r = {0 : '0', 'a' : 1, 'b' : 2, 'c' : {}, 'd' : []}
+    return s
 
+def test_serializability():
+    s = _everything()
     f = tempfile.TemporaryFile()
     s.dump(f)
     s.dump(f)
@@ -121,3 +126,259 @@ def test_interaction_with_file_likes():
     s0.load(buf)
 
     assert s == s0
+
+def test_dump_is_byte_for_byte():
+    s = EqHelper()
+    s.load(_path('good'))
+    buf = StringIO.StringIO()
+    s.dump(buf)
+    with open(_path('good'), 'rb') as f:
+        assert f.read() == buf.getvalue()
+
+    class Int(int): pass
+    s = EqHelper()
+    s.a = [Int(7), True, 1 << 70, [-1], 'x\n']
+    s.h = {'k' : 0.5, 3 : {}}
+    buf = StringIO.StringIO()
+    s.dump(buf)
+    assert ('\x1eSS EqHelper 2\n'
+        '^a a 5\n^i 0 7\n^i 1 1\n^i 2 1180591620717411303424\n'
+        '^a 3 1\n^i 0 -1\n^b 4 2\nx\n'
+        '^h h 2\n^i 0 3\n^h 0 0\n^b 1 1\nk^f 1 20\n0x1.0000000000000p-1'
+        ) == buf.getvalue()
+
+def test_out_of_order():
+    s = EqHelper()
+    for data in ('^a a 2\n^i 0 1\n^i 2 2\n', '^a a 1\n^b 1 1\nx',
+            '^h h 1\n^i 1 1\n^i 0 1\n', '^a a 1\n^i 0 x\n', '^q a 1\n'):
+        with assert_raises(pu.serializer.SelfSerializerError):
+            s.load(StringIO.StringIO('\x1eSS EqHelper 1\n' + data))
+
+def test_binary():
+    s = _everything()
+    s.ints = [0, -1, 1 << 40, 1 << 100, -(1 << 64), True]
+    s.small = range(-128, 128)
+    s.mid = [-1 << 15, 1 << 15]
+    s.flts = [0.5, -1e300, float('inf')]
+    s.mixed = [1, 1.5, 'x', [2.5, 3], {'k' : [1 << 63]}]
+    f = tempfile.TemporaryFile()
+    s.dump(f, binary = True)
+    s.dump(f)
+    s.dump(f, binary = True)
+    end = f.tell()
+    f.seek(0)
+    for i in xrange(3):
+        s0 = EqHelper()
+        s0.load(f)
+        assert s == s0
+    assert end == f.tell()
+
+    buf = StringIO.StringIO()
+    s.dump(buf, binary = True)
+    text = StringIO.StringIO()
+    s.dump(text)
+    assert len(buf.getvalue()) < len(text.getvalue()) // 2
+    assert buf.getvalue().startswith('\x1eSB EqHelper %d ' % len(vars(s)))
+
+    for data in (buf.getvalue()[:-1], buf.getvalue() + 'x'):
+        lines = data.split('\n', 1)
+        H = lines[0].split()
+        H[3] = str(len(lines[1]))
+        with assert_raises(pu.serializer.SelfSerializerError):
+            EqHelper().load(StringIO.StringIO(' '.join(H) + '\n' + lines[1]))
+    with assert_raises(pu.serializer.SelfSerializerError):
+        EqHelper().load(StringIO.StringIO(buf.getvalue()[:-1]))
+
+class Other(pu.serializer.SelfSerializer): pass
+
+def test_records():
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    idx = path + '.ssidx'
+    try:
+        made = []
+        for i in xrange(5):
+            s = Other() if 2 == i else EqHelper()
+            s.i = i
+            s.tricky = '\n\x1eSS EqHelper 1\n^i i 9\n'
+            s.dump(path, append = 0 != i, binary = 1 == i % 2)
+            made.append(s)
+        assert not os.path.exists(idx)
+
+        got = list(EqHelper.iter_records(path))
+        assert [r[0] for r in got] == ['EqHelper'] * 2 + ['Other'] + \
+            ['EqHelper'] * 2
+        assert got[2][2] is None
+        for i in (0, 1, 3, 4):
+            assert made[i] == got[i][2]
+            assert type(got[i][2]) is EqHelper
+        assert os.path.getsize(idx) == 12 + 8 * 5
+
+        offsets = [r[1] for r in got]
+        assert 0 == offsets[0]
+        for i in xrange(5):
+            name, off, inst = pu.serializer.SelfSerializer.load_record(
+                path, i)
+            assert off == offsets[i]
+            assert vars(inst) == vars(made[i])
+        assert type(inst) is EqHelper
+        with assert_raises(IndexError):
+            EqHelper.load_record(path, 5)
+
+        # dump() keeps the index up to date.
+        made[3].dump(path)
+        assert os.path.getsize(idx) == 12 + 8 * 6
+        assert 6 == EqHelper.count_records(path)
+        assert made[3] == EqHelper.load_record(path, 5)[2]
+
+        # A stale index is noticed and rebuilt.
+        made[4].dump(path, append = False)
+        assert 1 == EqHelper.count_records(path)
+        os.remove(idx)
+        with open(path, 'ab') as f:
+            made[0].dump(f)
+        assert 2 == EqHelper.count_records(path)
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 3)
+        records = EqHelper.iter_records(path)
+        assert made[4] == records.next()[2]
+        with assert_raises(pu.serializer.SelfSerializerError):
+            records.next()
+        with assert_raises(pu.serializer.SelfSerializerError):
+            EqHelper.count_records(path)
+    finally:
+        for p in (path, idx):
+            if os.path.exists(p): os.remove(p)
+
+def test_lazy():
+    s = _everything()
+    s.big = 'x' * 100000
+    s.ints = range(1000)
+    s.nest = {'k' : [1.5, 'y', {}], 2 : [1 << 70]}
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        s.dump(path, append = False)
+        s.dump(path, binary = True)
+        with open(path, 'rb') as f:
+            for i in xrange(2):
+                s0 = EqHelper()
+                s0.load(f, lazy = True)
+                assert 'ints' not in vars(s0)
+                assert isinstance(s0.big, buffer)
+                assert s.big == s0.big[:]
+                assert s.ints == s0.ints
+                assert 'ints' in vars(s0)
+                assert s.nest == s0.nest
+                with assert_raises(AttributeError):
+                    s0.missing
+                s0.ints = [7]
+
+                buf = StringIO.StringIO()
+                s0.dump(buf)
+                s1 = EqHelper()
+                s1.load(StringIO.StringIO(buf.getvalue()))
+                assert [7] == s1.ints
+                s1.ints = s.ints
+                assert s == s1
+            assert '' == f.read()
+
+        s0 = EqHelper()
+        s0.load(path, lazy = True)
+        s0.load(path)
+        assert s == s0
+        with assert_raises(pu.serializer.SelfSerializerError):
+            Other().load(path, lazy = True)
+
+        for binary in (False, True):
+            s.dump(path, append = False, binary = binary)
+            with open(path, 'r+b') as f:
+                f.truncate(os.path.getsize(path) - 3)
+            with assert_raises(pu.serializer.SelfSerializerError):
+                EqHelper().load(path, lazy = True)
+    finally:
+        os.remove(path)
+
+def test_lazy_data_container():
+    s = pu.serializer.SelfSerializingDataContainer(
+        n = 1, vals = range(100), d = {'k' : 'v'})
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        s.dump(path, append = False, binary = True)
+        s0 = pu.serializer.SelfSerializingDataContainer()
+        s0.load(path, lazy = True)
+        assert 'vals' not in vars(s0)
+        assert 'vals' in s0 and 'missing' not in s0
+        assert 3 == len(s0)
+        assert ['d', 'n', 'vals'] == sorted(s0.keys()) == sorted(s0)
+        assert 'vals' not in vars(s0)
+        assert range(100) == s0.get('vals') == s0['vals']
+        assert None == s0.get('missing')
+        assert sorted(s.items()) == sorted(s0.items())
+        assert vars(s) == vars(s0)
+
+        s0.load(path, lazy = True)
+        assert {'k' : 'v'} == s0.pop('d')
+        assert ['n', 'vals'] == sorted(s0)
+        s0.clear()
+        assert 0 == len(s0) and 'vals' not in s0
+    finally:
+        os.remove(path)
+
+def test_arrays():
+    s = EqHelper()
+    s.d = array.array('d', [0.5, -1e300, float('inf')] * 1000)
+    s.h = array.array('h', range(-1000, 1000))
+    s.B = array.array('B')
+    s.mixed = [array.array('l', [1 << 40]), {'k' : array.array('c', 'xy')}]
+    text = StringIO.StringIO()
+    s.dump(text)
+    assert '^n h 4002\nh2' + s.h.tostring() in text.getvalue()
+    assert '^n B 2\nB1^' in text.getvalue()
+    binary = StringIO.StringIO()
+    s.dump(binary, binary = True)
+    for buf in (text, binary):
+        buf.seek(0)
+        s0 = EqHelper()
+        s0.load(buf)
+        assert s == s0
+        assert array.array == type(s0.mixed[0])
+
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        s.dump(path, append = False)
+        s.dump(path, binary = True)
+        with open(path, 'rb') as f:
+            for i in xrange(2):
+                s0 = EqHelper()
+                s0.load(f, lazy = True)
+                assert 'd' not in vars(s0)
+                assert s.d == s0.d
+                assert s.mixed == s0.mixed
+                s0.materialize()
+                assert s == s0
+    finally:
+        os.remove(path)
+
+    for data in ('^n a 0\n', '^n a 1\nz', '^n a 2\nz1', '^n a 5\nh2123',
+            '^n a 3\nh0x', '^n a 10\nd4' + struct.pack('<f', 1),
+            '^n a 10\ni8' + struct.pack('<q', 1 << 40)):
+        with assert_raises(pu.serializer.SelfSerializerError):
+            EqHelper().load(StringIO.StringIO('\x1eSS EqHelper 1\n' + data))
+
+    # Items written where the typecode has another size are converted.
+    def load(payload):
+        s = EqHelper()
+        s.load(StringIO.StringIO('\x1eSS EqHelper 1\n^n a %d\n%s' % (
+            len(payload), payload)))
+        return s.a
+    assert array.array('l', [1, -2, 3]) == load(
+        'l4' + struct.pack('<3i', 1, -2, 3))
+    assert array.array('L', [1 << 31]) == load(
+        'L4' + struct.pack('<I', 1 << 31))
+    assert array.array('i', [-5]) == load('i8' + struct.pack('<q', -5))
+    other = 6 - array.array('u').itemsize
+    assert array.array('u', u'h\xe9') == load('u%d' % other +
+        u'h\xe9'.encode('utf-16-le' if 2 == other else 'utf-32-le'))
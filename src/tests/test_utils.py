@@ -1,7 +1,10 @@
 #
 # Copyright (c) 2012 Joshua Hughes <kivhift@gmail.com>
 #
+import hashlib
 import os
+import shutil
+import tempfile
 import time
 
 from nose.tools import assert_raises
@@ -211,3 +214,48 @@ def test_time_str():
     assert '-'.join(time_fld[:2]) == T('-', S = False, stamp = S)
     assert '-'.join(time_fld[:3]) == T('-', stamp = S)
     assert '-'.join(time_fld[::2]) == T('-', M = False, stamp = S)
+
+def test_hash_file_with_cache():
+    tmp = tempfile.mkdtemp()
+    try:
+        name = os.path.join(tmp, 'f')
+        with open(name, 'wb') as f:
+            f.write('hash me')
+        then = time.time() - 60
+        os.utime(name, (then, then))
+        cache = pu.utils.HashCache(os.path.join(tmp, 'cache'))
+        digest = hashlib.sha1('hash me').digest()
+        assert digest == pu.utils.hash_file(name, cache = cache)
+        assert digest.encode('hex') == cache.get(name)
+        assert cache.get(name, 'md5') is None
+        cache.close()
+        cache = pu.utils.HashCache(os.path.join(tmp, 'cache'))
+        assert digest.encode('hex') == cache.get(name)
+        with open(name, 'wb') as f:
+            f.write('hash me, too')
+        assert cache.get(name) is None
+        # Too fresh to be trusted.
+        assert hashlib.sha1('hash me, too').digest() == pu.utils.hash_file(
+            name, cache = cache)
+        assert cache.get(name) is None
+        cache.compact()
+        cache.close()
+
+        # compact() keeps the entry for what the file is now.
+        cache = pu.utils.HashCache(os.path.join(tmp, 'cache'))
+        for i in xrange(3):
+            with open(name, 'wb') as f:
+                f.write('version %d' % i)
+            then = time.time() - 600 + 60 * i
+            os.utime(name, (then, then))
+            pu.utils.hash_file(name, cache = cache)
+        digest = hashlib.sha1('version 2').hexdigest()
+        assert digest == cache.get(name)
+        cache.compact()
+        assert digest == cache.get(name)
+        cache.close()
+        cache = pu.utils.HashCache(os.path.join(tmp, 'cache'))
+        assert digest == cache.get(name)
+        cache.close()
+    finally:
+        shutil.rmtree(tmp)